@@ -0,0 +1,272 @@
+"""
+Broadcasts of a message to every chat the bot moderates.
+
+Deliveries go out concurrently under a global and a per-chat rate limit, and
+each one is recorded in SQLite as it completes, so a broadcast interrupted by
+a restart resumes with the chats it had not reached yet
+"""
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock, Thread
+
+from telegram import Chat, ChatMember
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+SEND_WORKERS = 8
+GLOBAL_RATE = 25  # messages per second, Telegram allows about 30
+CHAT_INTERVAL_SECONDS = 3  # Telegram allows about 20 messages per minute in a group
+MAX_ATTEMPTS = 5
+MAX_REPORTED_FAILURES = 10
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS managed_chats (chat_id INTEGER PRIMARY KEY, title TEXT, added REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS broadcasts ('
+    '  id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, created REAL NOT NULL, finished REAL)',
+    'CREATE TABLE IF NOT EXISTS broadcast_deliveries ('
+    '  broadcast_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, status TEXT NOT NULL, error TEXT,'
+    '  PRIMARY KEY (broadcast_id, chat_id))',
+)
+
+MANAGED_CHAT_TYPES = (Chat.GROUP, Chat.SUPERGROUP)
+
+
+class RateLimiter:
+    """
+    Spaces calls so there are at most rate per second overall,
+    and at least chat_interval seconds between two calls to the same chat
+    """
+
+    def __init__(self, rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL_SECONDS):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self._next = 0.0
+        self._next_by_chat = {}
+        self._lock = Lock()
+
+    def acquire(self, chat_id):
+        """
+        Waits for the turn of a call to a chat
+        :param chat_id: the chat id
+        """
+        with self._lock:
+            now = time.monotonic()
+            turn = max(now, self._next, self._next_by_chat.get(chat_id, 0.0))
+            self._next = turn + self.interval
+            self._next_by_chat[chat_id] = turn + self.chat_interval
+        if turn > now:
+            time.sleep(turn - now)
+
+    def delay(self, seconds):
+        """
+        Holds every call back, after Telegram asked to retry later
+        :param seconds: how long to wait
+        """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class BroadcastStore:
+    """
+    The managed chats and the progress of every broadcast, on a SQLite database.
+    It can share an open autocommit connection to the database, with the lock
+    every user of that connection holds
+    """
+
+    def __init__(self, path, db=None, lock=None):
+        self._lock = lock or Lock()
+        if db is None:
+            db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        self._db = db
+        with self._lock:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._chats = {chat_id for chat_id, in self._db.execute('SELECT chat_id FROM managed_chats')}
+
+    def add_chat(self, chat_id, title=None):
+        if chat_id in self._chats:
+            return
+        with self._lock:
+            self._chats.add(chat_id)
+            self._db.execute('INSERT OR REPLACE INTO managed_chats (chat_id, title, added) VALUES (?, ?, ?)',
+                             (chat_id, title, time.time()))
+
+    def remove_chat(self, chat_id):
+        with self._lock:
+            self._chats.discard(chat_id)
+            self._db.execute('DELETE FROM managed_chats WHERE chat_id = ?', (chat_id,))
+
+    def chats(self):
+        return sorted(self._chats)
+
+    def create(self, text):
+        """
+        Registers a broadcast with a pending delivery for every managed chat
+        :param text: the message text
+        :return: the broadcast id
+        """
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                broadcast_id = self._db.execute('INSERT INTO broadcasts (text, created) VALUES (?, ?)',
+                                                (text, time.time())).lastrowid
+                self._db.executemany('INSERT INTO broadcast_deliveries (broadcast_id, chat_id, status) '
+                                     'VALUES (?, ?, ?)', [(broadcast_id, chat_id, PENDING) for chat_id in self._chats])
+                self._db.execute('COMMIT')
+            except sqlite3.Error:
+                self._db.execute('ROLLBACK')
+                raise
+        return broadcast_id
+
+    def unfinished(self):
+        """
+        :return: a list of (broadcast id, text) of the broadcasts not finished yet
+        """
+        with self._lock:
+            return self._db.execute('SELECT id, text FROM broadcasts WHERE finished IS NULL ORDER BY id').fetchall()
+
+    def pending(self, broadcast_id):
+        """
+        :param broadcast_id: the broadcast id
+        :return: the ids of the chats the broadcast has not reached yet
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT chat_id FROM broadcast_deliveries WHERE broadcast_id = ? AND status = ?',
+                                    (broadcast_id, PENDING)).fetchall()
+        return [chat_id for chat_id, in rows]
+
+    def mark(self, broadcast_id, chat_id, status, error=None):
+        with self._lock:
+            self._db.execute('UPDATE broadcast_deliveries SET status = ?, error = ? '
+                             'WHERE broadcast_id = ? AND chat_id = ?', (status, error, broadcast_id, chat_id))
+
+    def finish(self, broadcast_id):
+        """
+        Marks a broadcast as finished
+        :param broadcast_id: the broadcast id
+        :return: a dict with its creation and finish times, sent count and failures as (chat id, error) tuples
+        """
+        finished = time.time()
+        with self._lock:
+            self._db.execute('UPDATE broadcasts SET finished = ? WHERE id = ?', (finished, broadcast_id))
+            created, = self._db.execute('SELECT created FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+            sent, = self._db.execute('SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? AND status = ?',
+                                     (broadcast_id, SENT)).fetchone()
+            failures = self._db.execute('SELECT chat_id, error FROM broadcast_deliveries '
+                                        'WHERE broadcast_id = ? AND status = ?', (broadcast_id, FAILED)).fetchall()
+        return {'created': created, 'finished': finished, 'sent': sent, 'failures': failures}
+
+
+class BroadcastEngine:
+    """
+    Sends broadcasts in background threads and reports each one when it finishes
+    """
+
+    def __init__(self, store, notify, workers=SEND_WORKERS, limiter=None):
+        self.store = store
+        self.notify = notify
+        self.workers = workers
+        self.limiter = limiter or RateLimiter()
+
+    def start(self, bot, text):
+        """
+        Starts a broadcast to every managed chat
+        :param bot: the bot
+        :param text: the message text
+        :return: the broadcast id and how many chats it goes to
+        """
+        broadcast_id = self.store.create(text)
+        chat_ids = self.store.pending(broadcast_id)
+        self._spawn(bot, broadcast_id, text, chat_ids)
+        return broadcast_id, len(chat_ids)
+
+    def resume(self, bot):
+        """
+        Resumes the broadcasts interrupted by a restart
+        :param bot: the bot
+        """
+        for broadcast_id, text in self.store.unfinished():
+            chat_ids = self.store.pending(broadcast_id)
+            logger.info('Reanudando la difusión %s, quedan %s grupos', broadcast_id, len(chat_ids))
+            self._spawn(bot, broadcast_id, text, chat_ids)
+
+    def _spawn(self, bot, broadcast_id, text, chat_ids):
+        # The report goes out with the settings of the bot which started the broadcast
+        Thread(target=copy_context().run, args=(self._run, bot, broadcast_id, text, chat_ids),
+               name=f'broadcast-{broadcast_id}', daemon=True).start()
+
+    def _run(self, bot, broadcast_id, text, chat_ids):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'broadcast-{broadcast_id}') as executor:
+            for chat_id in chat_ids:
+                executor.submit(self._deliver, bot, broadcast_id, chat_id, text)
+
+        report = self.store.finish(broadcast_id)
+        failures = report['failures']
+        lines = [f"Difusión {broadcast_id} completada en {report['finished'] - report['created']:.0f} s: "
+                 f"{report['sent']} enviados, {len(failures)} fallidos"]
+        lines += [f'  {chat_id}: {error}' for chat_id, error in failures[:MAX_REPORTED_FAILURES]]
+        try:
+            self.notify('\n'.join(lines))
+        except Exception:
+            logger.exception('No se pudo enviar el informe de la difusión %s', broadcast_id)
+
+    def _deliver(self, bot, broadcast_id, chat_id, text):
+        target = chat_id
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.limiter.acquire(target)
+            try:
+                bot.send_message(target, text)
+                self.store.mark(broadcast_id, chat_id, SENT)
+                return
+            except RetryAfter as e:
+                self.limiter.delay(e.retry_after)
+            except ChatMigrated as e:
+                self.store.remove_chat(target)
+                target = e.new_chat_id
+                self.store.add_chat(target)
+            except Unauthorized as e:
+                # The bot is no longer in the chat
+                self.store.remove_chat(chat_id)
+                self.store.mark(broadcast_id, chat_id, FAILED, e.message)
+                return
+            except BadRequest as e:
+                self.store.mark(broadcast_id, chat_id, FAILED, e.message)
+                return
+            except NetworkError as e:
+                logger.warning('Error de red en la difusión %s al grupo %s: %s', broadcast_id, target, e)
+                time.sleep(attempt)
+            except TelegramError as e:
+                self.store.mark(broadcast_id, chat_id, FAILED, e.message)
+                return
+            except Exception as e:
+                logger.exception('Error en la difusión %s al grupo %s', broadcast_id, target)
+                self.store.mark(broadcast_id, chat_id, FAILED, str(e))
+                return
+        self.store.mark(broadcast_id, chat_id, FAILED, f'Sin éxito tras {MAX_ATTEMPTS} intentos')
+
+
+def track_managed_chat(store, chat_member_update):
+    """
+    Adds or removes a chat from the managed chats after a change of the bot membership
+    :param store: the BroadcastStore
+    :param chat_member_update: the ChatMemberUpdated of the bot itself
+    """
+    chat = chat_member_update.chat
+    if chat.type not in MANAGED_CHAT_TYPES:
+        return
+    status = chat_member_update.new_chat_member.status
+    if status in (ChatMember.MEMBER, ChatMember.ADMINISTRATOR):
+        store.add_chat(chat.id, chat.title)
+    elif status in (ChatMember.LEFT, ChatMember.KICKED):
+        store.remove_chat(chat.id)
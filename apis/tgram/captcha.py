@@ -0,0 +1,100 @@
+"""
+Compact bookkeeping of the captchas waiting for an answer
+"""
+import sys
+import time
+from threading import Lock
+
+from cachetools import TTLCache
+
+APPROVED_JOIN_TTL_SECONDS = 300
+
+
+class PendingCaptcha:
+    """
+    A captcha waiting for its answer, kept as a few ints and a short string
+    instead of the whole User and Message objects.
+    For join requests chat_id is the private chat holding the captcha
+    and join_chat_id the chat the user asked to join. answer is the key
+    of the answer in the challenge the user was sent
+    """
+    __slots__ = ('chat_id', 'user_id', 'message_id', 'name', 'created', 'deadline', 'job', 'join_chat_id', 'answer')
+
+    def __init__(self, chat_id, user_id, message_id, name, timeout, join_chat_id=None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.name = sys.intern(name)
+        self.created = time.time()
+        self.deadline = self.created + timeout
+        self.job = None
+        self.join_chat_id = join_chat_id
+        self.answer = None
+
+
+class PendingCaptchas:
+    """
+    Thread-safe registry of pending captchas by chat and user,
+    the chat asked to join for join requests
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = Lock()
+
+    def add(self, pending):
+        """
+        Registers a pending captcha, replacing a previous one for the same chat and user
+        :param pending: the PendingCaptcha
+        """
+        with self._lock:
+            self._pending[(pending.join_chat_id or pending.chat_id, pending.user_id)] = pending
+
+    def get(self, chat_id, user_id):
+        """
+        Returns a pending captcha, leaving it registered
+        :param chat_id: the chat id
+        :param user_id: the user id
+        :return: the PendingCaptcha or None if there is none
+        """
+        with self._lock:
+            return self._pending.get((chat_id, user_id))
+
+    def pop(self, chat_id, user_id):
+        """
+        Removes a pending captcha. Only the first caller gets it,
+        so the answer and the timeout can never both act on it
+        :param chat_id: the chat id
+        :param user_id: the user id
+        :return: the PendingCaptcha or None if it was already resolved
+        """
+        with self._lock:
+            return self._pending.pop((chat_id, user_id), None)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class ApprovedJoins:
+    """
+    Users whose join request was just approved, so the join service
+    message that follows does not challenge them again
+    """
+
+    def __init__(self, ttl=APPROVED_JOIN_TTL_SECONDS, maxsize=10000):
+        self._approved = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = Lock()
+
+    def add(self, chat_id, user_id):
+        with self._lock:
+            self._approved[(chat_id, user_id)] = True
+
+    def pop(self, chat_id, user_id):
+        """
+        Consumes an approval
+        :param chat_id: the chat id
+        :param user_id: the user id
+        :return: True if the user had just been approved in the chat
+        """
+        with self._lock:
+            return self._approved.pop((chat_id, user_id), False)
@@ -0,0 +1,166 @@
+"""
+Bank of pre-generated captcha challenges.
+
+The layouts are generated in batches with numpy and kept with their inline
+keyboard already serialized, with a marker where the per-user part of the
+callback data goes. Drawing a challenge is a pop and a string replace
+"""
+import json
+import random
+from collections import deque
+from threading import Lock, Thread
+
+import numpy as np
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+POOL_SIZE = 512
+REFILL_THRESHOLD = 128
+USER_MARKER = '<user>'
+
+
+class Challenge:
+    """
+    A challenge with its inline keyboard serialized as JSON
+    """
+    __slots__ = ('prompt', 'answer', 'template')
+
+    def __init__(self, prompt, answer, template):
+        self.prompt = prompt
+        self.answer = answer
+        self.template = template
+
+    def markup(self, user_id, name):
+        """
+        Returns the reply markup of the challenge for a user
+        :param user_id: the user id
+        :param name: the user first name
+        :return: the inline keyboard JSON, as the Bot API takes it
+        """
+        return self.template.replace(USER_MARKER, json.dumps(f'{user_id},{name}', ensure_ascii=False)[1:-1])
+
+
+class ChallengeSet:
+    """
+    A kind of challenge: a prompt, the decoys and the answers,
+    one of which is among the decoys in every challenge
+    """
+
+    def __init__(self, name, prompt, decoys, answers, rows=4, columns=4):
+        if len(decoys) < rows * columns - 1:
+            raise ValueError(f'El conjunto {name} necesita al menos {rows * columns - 1} señuelos')
+        self.name = name
+        self.prompt = prompt
+        self.rows = rows
+        self.columns = columns
+        self.answer_keys = tuple(answers)
+        self.decoy_keys = tuple(decoys)
+        self._buttons = [json.dumps({'text': emoji, 'callback_data': f'{key},{USER_MARKER}'}, ensure_ascii=False)
+                         for key, emoji in list(decoys.items()) + list(answers.items())]
+
+    def generate(self, count, rng):
+        """
+        Generates challenges
+        :param count: how many
+        :param rng: the numpy random generator
+        :return: a list of Challenges
+        """
+        cells = self.rows * self.columns
+        decoys = len(self.decoy_keys)
+        # Every row, a random choice of decoys with the answer in a random cell
+        layouts = np.empty((count, cells), dtype=np.int64)
+        answer_cells = np.arange(cells) == rng.integers(cells, size=count)[:, None]
+        answers = decoys + rng.integers(len(self.answer_keys), size=count)
+        layouts[answer_cells] = answers
+        layouts[~answer_cells] = rng.permuted(np.tile(np.arange(decoys), (count, 1)), axis=1)[:, :cells - 1].ravel()
+
+        challenges = []
+        buttons = self._buttons
+        for layout, answer in zip(layouts.tolist(), answers.tolist()):
+            rows = ('[' + ', '.join(buttons[index] for index in layout[row:row + self.columns]) + ']'
+                    for row in range(0, cells, self.columns))
+            template = '{"inline_keyboard": [' + ', '.join(rows) + ']}'
+            challenges.append(Challenge(self.prompt, self.answer_keys[answer - decoys], template))
+        return challenges
+
+
+class ChallengeBank:
+    """
+    Pools of pre-generated challenges, one per set, refilled in a background
+    thread when they run low. Each chat draws from its own sets, the default
+    ones when it has none
+    """
+
+    def __init__(self, sets, chat_sets=None, default_sets=None, pool_size=POOL_SIZE, refill_threshold=REFILL_THRESHOLD):
+        self.sets = {challenge_set.name: challenge_set for challenge_set in sets}
+        self.chat_sets = {chat_id: tuple(names) for chat_id, names in (chat_sets or {}).items()}
+        self.default_sets = tuple(default_sets or list(self.sets)[:1])
+        self.pool_size = pool_size
+        self.refill_threshold = refill_threshold
+        self._rng = np.random.default_rng()
+        self._rng_lock = Lock()
+        self._pools = {name: deque() for name in self.sets}
+        self._refilling = set()
+        self._refill_lock = Lock()
+
+        # The answers of a chat must never be decoys of another of its sets
+        for names in set(self.chat_sets.values()) | {self.default_sets}:
+            answers = {key for name in names for key in self.sets[name].answer_keys}
+            decoys = {key for name in names for key in self.sets[name].decoy_keys}
+            if answers & decoys:
+                raise ValueError(f'Respuestas usadas como señuelo en {names}: {answers & decoys}')
+
+        for name in self.sets:
+            self._refill(name)
+
+    def draw(self, chat_id):
+        """
+        Takes a challenge for a chat
+        :param chat_id: the chat id
+        :return: the Challenge
+        """
+        name = random.choice(self.chat_sets.get(chat_id, self.default_sets))
+        pool = self._pools[name]
+        if len(pool) < self.refill_threshold:
+            self._start_refill(name)
+        try:
+            return pool.popleft()
+        except IndexError:
+            # Only when the joins outrun the refill
+            return self._generate(name, 1)[0]
+
+    def is_answer(self, chat_id, key):
+        """
+        Checks a pressed button against every answer of the chat, for captchas
+        no longer pending, whose challenge is not known
+        :param chat_id: the chat id
+        :param key: the key of the pressed button
+        :return: True if it is an answer of the sets of the chat
+        """
+        return any(key in self.sets[name].answer_keys for name in self.chat_sets.get(chat_id, self.default_sets))
+
+    def _generate(self, name, count):
+        with self._rng_lock:
+            return self.sets[name].generate(count, self._rng)
+
+    def _refill(self, name):
+        pool = self._pools[name]
+        pool.extend(self._generate(name, self.pool_size - len(pool)))
+
+    def _start_refill(self, name):
+        with self._refill_lock:
+            if name in self._refilling:
+                return
+            self._refilling.add(name)
+        Thread(target=self._refill_loop, args=(name,), name=f'challenges-{name}', daemon=True).start()
+
+    def _refill_loop(self, name):
+        try:
+            self._refill(name)
+        except Exception:
+            logger.exception('Error al generar desafíos del conjunto %s', name)
+        finally:
+            with self._refill_lock:
+                self._refilling.discard(name)
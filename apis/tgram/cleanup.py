@@ -0,0 +1,69 @@
+"""
+Batched deletion of join service messages and captcha prompts
+"""
+from collections import defaultdict
+from threading import Lock
+
+from telegram.error import TelegramError
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+MAX_BATCH_SIZE = 100  # Bot API limit for deleteMessages
+FLUSH_INTERVAL_SECONDS = 5
+
+
+class MessageCleaner:
+    """
+    Collects message ids per chat and deletes them in batches through
+    the deleteMessages Bot API method, so a join storm costs one call
+    per hundred leftovers instead of one call per message
+    """
+
+    def __init__(self, batch_size=MAX_BATCH_SIZE):
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._pending = defaultdict(list)
+        self._lock = Lock()
+
+    def schedule(self, bot, chat_id, *message_ids):
+        """
+        Queues messages for deletion, deleting right away
+        when the chat reaches the batch size
+        :param bot: the bot used when the batch is full
+        :param chat_id: the chat id
+        :param message_ids: the ids of the messages to delete
+        """
+        batch = None
+        with self._lock:
+            pending = self._pending[chat_id]
+            pending.extend(message_ids)
+            if len(pending) >= self.batch_size:
+                batch = pending[:self.batch_size]
+                del pending[:self.batch_size]
+        if batch:
+            self._delete(bot, chat_id, batch)
+
+    def flush(self, bot):
+        """
+        Deletes every queued message
+        :param bot: the bot doing the deletion
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(list)
+        for chat_id, message_ids in pending.items():
+            for start in range(0, len(message_ids), self.batch_size):
+                self._delete(bot, chat_id, message_ids[start:start + self.batch_size])
+
+    def flush_job(self, context):
+        """
+        Job queue callback flushing the queued messages
+        :param context: the context
+        """
+        self.flush(context.bot)
+
+    def _delete(self, bot, chat_id, message_ids):
+        try:
+            bot._post('deleteMessages', {'chat_id': chat_id, 'message_ids': message_ids})
+        except TelegramError as e:
+            logger.warning('No se pudieron borrar %d mensajes del chat %s: %s', len(message_ids), chat_id, e)
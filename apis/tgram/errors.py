@@ -0,0 +1,119 @@
+"""
+Aggregation of handler errors, so an outage produces one alert
+per kind of error and interval instead of a flood of logs and messages
+"""
+import hashlib
+import time
+import traceback
+from threading import Lock
+
+from cachetools import LRUCache
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+ALERT_INTERVAL_SECONDS = 600
+FLUSH_INTERVAL_SECONDS = 30
+MAX_FINGERPRINTS = 256
+MAX_SAMPLES = 5
+MAX_MESSAGE_LENGTH = 200
+
+
+class ErrorStats:
+    """
+    Counters of one kind of error
+    """
+    __slots__ = ('fingerprint', 'location', 'message', 'total', 'pending', 'samples', 'last_alert')
+
+    def __init__(self, fingerprint, location, message):
+        self.fingerprint = fingerprint
+        self.location = location
+        self.message = message
+        self.total = 0
+        self.pending = 0
+        self.samples = []
+        self.last_alert = None
+
+
+def fingerprint(error):
+    """
+    Identifies an error by its type and the place where it was raised
+    :param error: the exception
+    :return: a (fingerprint, location) tuple
+    """
+    frames = traceback.extract_tb(error.__traceback__) if error.__traceback__ else []
+    where = f'{frames[-1].filename}:{frames[-1].lineno} en {frames[-1].name}' if frames else 'sin traza'
+    location = f'{type(error).__name__} @ {where}'
+    return hashlib.sha1(location.encode()).hexdigest()[:10], location
+
+
+class ErrorAggregator:
+    """
+    Counts errors by fingerprint in a bounded LRU. The first occurrence of each
+    fingerprint is logged with its traceback and alerted on the next flush, the
+    following ones are only counted and summarized at most once per interval
+    """
+
+    def __init__(self, notify, interval=ALERT_INTERVAL_SECONDS, maxsize=MAX_FINGERPRINTS):
+        self.notify = notify
+        self.interval = interval
+        self._stats = LRUCache(maxsize=maxsize)
+        self._lock = Lock()
+
+    def report(self, error, update=None):
+        """
+        Records an error
+        :param error: the exception
+        :param update: the update being handled when it was raised, if any
+        """
+        key, location = fingerprint(error)
+        update_id = getattr(update, 'update_id', None)
+        with self._lock:
+            stats = self._stats.get(key)
+            new = stats is None
+            if new:
+                stats = self._stats[key] = ErrorStats(key, location, str(error)[:MAX_MESSAGE_LENGTH])
+            stats.total += 1
+            stats.pending += 1
+            if update_id is not None and len(stats.samples) < MAX_SAMPLES:
+                stats.samples.append(update_id)
+
+        if new:
+            logger.warning('Error [%s] %s (update %s): %s', key, location, update_id, error, exc_info=error)
+        else:
+            logger.debug('Error [%s] repetido (update %s)', key, update_id)
+
+    def flush(self):
+        """
+        Sends one alert for each fingerprint which is new or whose interval has passed
+        """
+        now = time.monotonic()
+        alerts = []
+        with self._lock:
+            for stats in self._stats.values():
+                if stats.pending and (stats.last_alert is None or now - stats.last_alert >= self.interval):
+                    alerts.append(self._summary(stats))
+                    stats.pending = 0
+                    stats.samples = []
+                    stats.last_alert = now
+
+        for alert in alerts:
+            try:
+                self.notify(alert)
+            except Exception:
+                logger.exception('No se pudo enviar la alerta de errores')
+
+    def flush_job(self, context):
+        """
+        Job queue callback sending the due alerts
+        :param context: the context
+        """
+        self.flush()
+
+    def _summary(self, stats):
+        samples = ', '.join(str(update_id) for update_id in stats.samples) or '-'
+        return (f'⚠️ Error [{stats.fingerprint}] {stats.location}\n'
+                f'{stats.message}\n'
+                f'{stats.pending} veces desde el último aviso ({stats.total} en total)\n'
+                f'Updates: {samples}')
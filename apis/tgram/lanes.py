@@ -0,0 +1,149 @@
+"""
+Named execution lanes, so slow handlers cannot hold up the others.
+
+Each lane has its own thread pool. Handlers are assigned to a lane when
+they are registered and return a Promise right away, as run_async handlers do,
+so the callbacks of a persistent ConversationHandler don't belong in a lane:
+they submit their slow work to one with Lane.submit and return their state.
+The lanes are shared by every hosted bot, and each callback runs in the context
+it was queued from.
+"""
+import time
+from collections import deque
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from threading import Lock
+
+from telegram.ext import DispatcherHandlerStop
+from telegram.ext.utils.promise import Promise
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+MODERATION = 'moderation'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+WAIT_SAMPLES = 1000
+
+lanes = {}
+
+
+class Lane:
+    """
+    A thread pool with queue depth and wait time metrics.
+    A lane of size 0 runs its handlers inline in the dispatcher thread
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f'lane-{name}') if size else None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self._lock = Lock()
+
+    def submit(self, dispatcher, callback, update, context):
+        """
+        Queues a handler callback in this lane
+        :param dispatcher: the dispatcher handling the update
+        :param callback: the handler callback
+        :param update: the update info from Telegram
+        :param context: the context
+        :return: the Promise of the callback result
+        """
+        promise = Promise(callback, (update, context), {}, update=update)
+        with self._lock:
+            self.queued += 1
+        if self.executor:
+            self.executor.submit(copy_context().run, self._run, dispatcher, promise, time.perf_counter())
+        else:
+            self._run(dispatcher, promise, time.perf_counter())
+        return promise
+
+    def stats(self):
+        """
+        Returns the current metrics of this lane
+        :return: a dict with size, queued, running, completed and wait times in milliseconds
+        """
+        with self._lock:
+            waits = sorted(self.waits)
+            queued, running, completed = self.queued, self.running, self.completed
+        return {
+            'name': self.name,
+            'size': self.size,
+            'queued': queued,
+            'running': running,
+            'completed': completed,
+            'wait_p50_ms': waits[len(waits) // 2] * 1000 if waits else 0.0,
+            'wait_p95_ms': waits[int(len(waits) * 0.95)] * 1000 if waits else 0.0,
+            'wait_max_ms': waits[-1] * 1000 if waits else 0.0,
+        }
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+    def _run(self, dispatcher, promise, enqueued):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.waits.append(time.perf_counter() - enqueued)
+        try:
+            promise.run()
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+        if not promise.exception:
+            dispatcher.update_persistence(update=promise.update)
+        elif isinstance(promise.exception, DispatcherHandlerStop):
+            logger.warning('DispatcherHandlerStop no está soportado en la cola %s: %s',
+                           self.name, promise.pooled_function.__name__)
+        else:
+            try:
+                dispatcher.dispatch_error(promise.update, promise.exception, promise=promise)
+            except Exception:
+                logger.exception('An uncaught error was raised while handling the error.')
+
+
+def configure_lanes(sizes):
+    """
+    Creates the lanes, replacing the previous ones
+    :param sizes: a dict from lane name to its number of threads
+    """
+    for lane in lanes.values():
+        lane.shutdown()
+    lanes.clear()
+    for name, size in sizes.items():
+        lanes[name] = Lane(name, size)
+
+
+def in_lane(name, callback):
+    """
+    Wraps a handler callback so it runs in a lane
+    :param name: the lane name
+    :param callback: the handler callback
+    :return: the wrapped callback
+    """
+    @wraps(callback)
+    def wrapped(update, context):
+        return lanes[name].submit(context.dispatcher, callback, update, context)
+    return wrapped
+
+
+def lanes_stats():
+    """
+    Returns the metrics of every lane
+    :return: a list of dicts, one per lane
+    """
+    return [lane.stats() for lane in lanes.values()]
+
+
+def total_lane_threads():
+    return sum(lane.size for lane in lanes.values())
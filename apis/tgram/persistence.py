@@ -0,0 +1,196 @@
+"""
+SQLite persistence for conversations, chat, user and bot data
+"""
+import json
+import pickle
+import sqlite3
+from collections import defaultdict
+from threading import Event, Lock, Thread
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.promise import Promise
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 10
+DATA_TABLES = ('user_data', 'chat_data', 'bot_data')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS conversations ('
+    '  name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key))',
+)
+
+
+class LazyDataDict(defaultdict):
+    """
+    defaultdict which loads each key from the database the first time it is used,
+    so only the chats and users seen since the start are kept in memory
+    """
+
+    def __init__(self, loader, *args):
+        super().__init__(dict, *args)
+        self._loader = loader
+
+    def __missing__(self, key):
+        value = self._loader(key)
+        self[key] = value
+        return value
+
+    def copy(self):
+        return type(self)(self._loader, self)
+
+    __copy__ = copy
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence on a SQLite database in WAL mode.
+
+    Every entry is pickled on its own and only written when it changed:
+    updates just mark the entry as dirty and a background thread writes all
+    the dirty entries in a single transaction every flush_interval seconds
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL_SECONDS):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db_lock = Lock()
+        self._dirty_lock = Lock()
+        self._digests = {}
+        self._dirty = {'user_data': {}, 'chat_data': {}, 'bot_data': {}, 'conversations': {}}
+        self._stop = Event()
+        self._flusher = None
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self._db.execute(statement)
+
+    def get_user_data(self):
+        return LazyDataDict(lambda user_id: self._load('user_data', user_id))
+
+    def get_chat_data(self):
+        return LazyDataDict(lambda chat_id: self._load('chat_data', chat_id))
+
+    def get_bot_data(self):
+        return self._load('bot_data', 0)
+
+    def get_conversations(self, name):
+        with self._db_lock:
+            rows = self._db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def update_user_data(self, user_id, data):
+        self._mark_dirty('user_data', user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._mark_dirty('chat_data', chat_id, data)
+
+    def update_bot_data(self, data):
+        self._mark_dirty('bot_data', 0, data)
+
+    def update_conversation(self, name, key, new_state):
+        # A state still being computed in the background comes as (old state, Promise),
+        # the old one is kept and the ConversationHandler persists the new one once resolved
+        while isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            new_state = new_state[0]
+        conversation_key = (name, json.dumps(key))
+        blob = None if new_state is None else pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)
+        with self._dirty_lock:
+            self._dirty['conversations'][conversation_key] = blob
+        self._start_flusher()
+
+    def flush(self):
+        """
+        Writes every dirty entry in a single transaction
+        """
+        with self._dirty_lock:
+            dirty = self._dirty
+            self._dirty = {table: {} for table in dirty}
+        if not any(dirty.values()):
+            return
+
+        with self._db_lock:
+            self._db.execute('BEGIN')
+            try:
+                for table in DATA_TABLES:
+                    self._db.executemany(f'INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)',
+                                         dirty[table].items())
+                for (name, key), state in dirty['conversations'].items():
+                    if state is None:
+                        self._db.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+                    else:
+                        self._db.execute('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                                         (name, key, state))
+                self._db.execute('COMMIT')
+            except sqlite3.Error:
+                self._db.execute('ROLLBACK')
+                logger.exception('Error al guardar los datos persistentes')
+                self._requeue(dirty)
+                return
+
+        # Only what is in the database counts as clean
+        with self._dirty_lock:
+            for table in DATA_TABLES:
+                for key, blob in dirty[table].items():
+                    self._digests[(table, key)] = hash(blob)
+
+    def share_connection(self):
+        """
+        Returns the connection, so other stores on the same database don't open theirs
+        :return: the connection and the lock every use of it must hold
+        """
+        return self._db, self._db_lock
+
+    def close(self):
+        """
+        Stops the background flushes, writing the pending entries
+        """
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _load(self, table, key):
+        with self._db_lock:
+            row = self._db.execute(f'SELECT data FROM {table} WHERE id = ?', (key,)).fetchone()
+        if not row:
+            return {}
+        self._digests[(table, key)] = hash(row[0])
+        return self.insert_bot(pickle.loads(row[0]))
+
+    def _mark_dirty(self, table, key, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        digest = hash(blob)
+        with self._dirty_lock:
+            if key not in self._dirty[table] and self._digests.get((table, key)) == digest:
+                return
+            self._dirty[table][key] = blob
+        self._start_flusher()
+
+    def _requeue(self, dirty):
+        # Entries marked again since the failed flush are newer and win
+        with self._dirty_lock:
+            for table, entries in dirty.items():
+                for key, blob in entries.items():
+                    self._dirty[table].setdefault(key, blob)
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            with self._dirty_lock:
+                if self._flusher is None:
+                    self._flusher = Thread(target=self._flush_loop, name='persistence-flusher', daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,149 @@
+"""
+Recording of the incoming update stream as a compressed
+newline-delimited JSON log, with personal data scrubbed
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+FLUSH_EVERY = 100
+PII_KEYS = ('first_name', 'last_name', 'username', 'phone_number', 'title', 'bio', 'file_name', 'vcard')
+FILE_KEYS = ('file_id', 'file_unique_id')
+# Free text written by users, only their string values: invite_link is also a ChatInviteLink object.
+# The command of a text is kept, without its arguments, so the replay hits the same handlers
+TEXT_KEYS = ('text', 'caption', 'query', 'description', 'question', 'explanation', 'address', 'invite_link', 'name')
+# Objects whose id is a user or chat id
+ACCOUNT_KEYS = ('from', 'chat', 'user', 'sender_chat', 'new_chat_members', 'left_chat_member',
+                'forward_from', 'forward_from_chat', 'via_bot', 'creator')
+# Bare user or chat ids
+ID_KEYS = ('user_id', 'migrate_to_chat_id', 'migrate_from_chat_id')
+LOCATION_KEYS = ('latitude', 'longitude')
+
+
+class UpdateRecorder:
+    """
+    Writes every update it receives to a gzip log, one JSON entry per line:
+        {"t": <reception timestamp>, "u": <scrubbed update>}
+    User and chat ids are replaced by keyed hashes, so the same user keeps
+    the same pseudonymous id all along one log. The key is kept next to the log,
+    at <path>.salt, so a restart appending to the log keeps the ids; it must not
+    be shared with the log, as it links the ids back to the real ones
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._salt = self._load_salt(path)
+        self._lock = Lock()
+        self._pending = 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def record(self, update, context):
+        """
+        Handler callback which appends the update to the log
+        :param update: the update info from Telegram
+        :param context: the context
+        """
+        entry = {'t': round(time.time(), 3), 'u': self.scrub(update.to_dict())}
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._pending += 1
+            if self._pending >= FLUSH_EVERY:
+                self._file.flush()
+                self._pending = 0
+
+    def close(self):
+        """
+        Flushes and closes the log
+        """
+        with self._lock:
+            self._file.close()
+        logger.info(f'Registro de actualizaciones guardado en {self.path}')
+
+    def scrub(self, data, account=False):
+        """
+        Returns a copy of the update dict without tokens and personal data
+        :param data: the update as a dict
+        :param account: if data is a user or chat, found under one of the ACCOUNT_KEYS
+        :return: the scrubbed dict
+        """
+        if isinstance(data, list):
+            return [self.scrub(item, account) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in PII_KEYS and isinstance(value, str):
+                value = 'x' * len(value)
+            elif key in FILE_KEYS:
+                value = self._hash(value, 'file')
+            elif key == 'id' and account and not data.get('is_bot'):
+                value = self._pseudonym(value)
+            elif key in ID_KEYS and isinstance(value, int):
+                value = self._pseudonym(value)
+            elif key in TEXT_KEYS and isinstance(value, str):
+                value = self._scrub_text(value) if key == 'text' else 'x' * len(value)
+            elif key in LOCATION_KEYS:
+                value = 0.0
+            elif key == 'data':
+                value = self._scrub_callback_data(value)
+            else:
+                value = self.scrub(value, key in ACCOUNT_KEYS)
+            result[key] = value
+        return result
+
+    @staticmethod
+    def _load_salt(path):
+        salt_path = f'{path}.salt'
+        if os.path.exists(salt_path):
+            with open(salt_path, 'rb') as salt_file:
+                return salt_file.read()
+        if os.path.exists(path):
+            raise ValueError(f'{path} ya existe sin su clave {salt_path}, los ids no coincidirían')
+        salt = os.urandom(16)
+        with open(salt_path, 'wb') as salt_file:
+            salt_file.write(salt)
+        return salt
+
+    @staticmethod
+    def _scrub_text(text):
+        if text.startswith('/'):
+            command, separator, arguments = text.partition(' ')
+            return command + separator + 'x' * len(arguments)
+        return 'x' * len(text)
+
+    def _scrub_callback_data(self, value):
+        # Captcha buttons carry '<answer>,<user id or chat asked to join>,<first name>'
+        parts = str(value).split(',', 2)
+        if len(parts) == 3 and parts[1].lstrip('-').isdigit():
+            return f'{parts[0]},{self._pseudonym(int(parts[1]))},{"x" * len(parts[2])}'
+        return value
+
+    def _pseudonym(self, value):
+        digest = hashlib.blake2b(str(value).encode(), key=self._salt, digest_size=5).digest()
+        pseudonym = int.from_bytes(digest, 'big')
+        return -pseudonym if value < 0 else pseudonym
+
+    def _hash(self, value, prefix):
+        return f'{prefix}-{hashlib.blake2b(str(value).encode(), key=self._salt, digest_size=8).hexdigest()}'
+
+
+def read_log(path):
+    """
+    Iterates over a recorded log
+    :param path: the log path
+    :return: an iterator of (timestamp, update dict) tuples
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as log_file:
+        for line in log_file:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['t'], entry['u']
@@ -0,0 +1,115 @@
+"""
+Routing of raw updates before they are decoded.
+
+Most updates in a busy group are plain chatter no handler wants. The router looks
+at the JSON of each update and drops the ones no route matches, so no Update
+object graph is built for them
+"""
+from threading import Lock
+
+from telegram.ext import ExtBot
+from telegram.utils.helpers import DEFAULT_NONE
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+MESSAGE_TYPES = ('message', 'edited_message')
+
+
+def update_types(*types):
+    """
+    Route for every update of some types
+    :param types: the update types, eg. callback_query
+    :return: the route
+    """
+    def route(data):
+        return any(update_type in data for update_type in types)
+    return route
+
+
+def _message(data):
+    for update_type in MESSAGE_TYPES:
+        if update_type in data:
+            return data[update_type]
+    return None
+
+
+def command(data):
+    """
+    Route for messages starting with a bot command
+    """
+    message = _message(data)
+    return bool(message) and any(entity.get('type') == 'bot_command' and entity.get('offset') == 0
+                                 for entity in message.get('entities') or ())
+
+
+def new_chat_members(data):
+    """
+    Route for the service messages of new members
+    """
+    return bool(data.get('message', {}).get('new_chat_members'))
+
+
+def private_document(data):
+    """
+    Route for documents sent in a private chat
+    """
+    message = _message(data)
+    return bool(message) and 'document' in message and message.get('chat', {}).get('type') == 'private'
+
+
+class UpdateRouter:
+    """
+    Keeps the raw updates matching any of its routes and counts the dropped ones
+    """
+
+    def __init__(self, routes):
+        self.routes = tuple(routes)
+        self.kept = 0
+        self.dropped = 0
+        self._lock = Lock()
+
+    def wants(self, data):
+        """
+        Checks a raw update
+        :param data: the update JSON dict
+        :return: True if some route matches it
+        """
+        wanted = any(route(data) for route in self.routes)
+        with self._lock:
+            if wanted:
+                self.kept += 1
+            else:
+                self.dropped += 1
+        return wanted
+
+    def filter(self, updates):
+        """
+        Drops the raw updates of a getUpdates batch no route matches.
+        When the last one is dropped its bare update_id is kept,
+        so the next offset still moves past the whole batch
+        :param updates: the list of update JSON dicts
+        :return: the list of wanted update JSON dicts
+        """
+        wanted = [data for data in updates if self.wants(data)]
+        if updates and (not wanted or wanted[-1] is not updates[-1]):
+            wanted.append({'update_id': updates[-1]['update_id']})
+        return wanted
+
+
+class RoutingBot(ExtBot):
+    """
+    ExtBot which routes the polled updates before decoding them
+    """
+    __slots__ = ('router',)
+
+    def __init__(self, *args, router=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+
+    def _post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        result = super()._post(endpoint, data, timeout=timeout, api_kwargs=api_kwargs)
+        if endpoint == 'getUpdates' and self.router and result:
+            return self.router.filter(result)
+        return result
@@ -0,0 +1,285 @@
+"""
+Hosting of many bots in one process.
+
+Each bot is a tenant with its own dispatcher, job queue, settings and moderation
+state, while the HTTP connection pool, the scheduler thread, the execution lanes
+and the webhook server are shared by all of them. The tenant of the running code
+follows the update or job being handled through a context variable, so the config
+getters and the reply helpers pick the right settings and bot without being told
+"""
+import time
+from functools import wraps
+from queue import Queue
+from signal import SIGABRT, SIGINT, SIGTERM, signal
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+import pytz
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+from apscheduler.schedulers.background import BackgroundScheduler
+from telegram.ext import Dispatcher, JobQueue, Updater
+from telegram.ext.utils.webhookhandler import WebhookServer
+
+from apis.tgram import webhook_reply
+from apis.tgram.broadcast import BroadcastEngine, BroadcastStore
+from apis.tgram.captcha import ApprovedJoins, PendingCaptchas
+from apis.tgram.cleanup import MessageCleaner
+from apis.tgram.errors import ErrorAggregator
+from apis.tgram.persistence import SQLitePersistence
+from apis.tgram.transport import TunedRequest, build_bot
+from common.utils.events import EventBuffer
+from common.utils.reputation import ReputationStore
+from config.environments import get_bot_api_file_url, get_bot_api_url, get_bot_url, get_events_path, \
+    get_persistence_path, get_reputation_path, get_tenant_name, tenant_settings
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+TENANT_WORKERS = 1  # The handlers run in the lanes, the dispatcher pool is barely used
+TENANT_CONNECTIONS = TENANT_WORKERS + 4  # As Updater expects: workers, dispatcher, polling, jobs and main thread
+
+tenants = {}
+
+
+def current_tenant():
+    """
+    Returns the tenant of the update or job being handled in the current thread
+    :return: the Tenant, None outside of any tenant
+    """
+    return tenants.get(get_tenant_name())
+
+
+class SchedulerView:
+    """
+    The jobs of one tenant on the scheduler shared by every tenant, as a JobQueue sees it.
+    Job ids get the tenant name as prefix, so its listeners and job listings only see
+    its own jobs, and the jobs run with the tenant active
+    """
+
+    def __init__(self, scheduler, tenant_name):
+        self.scheduler = scheduler
+        self.tenant_name = tenant_name
+        self.prefix = f'{tenant_name}:'
+
+    @property
+    def timezone(self):
+        return self.scheduler.timezone
+
+    @property
+    def running(self):
+        return self.scheduler.running
+
+    def add_job(self, func, *args, id=None, **kwargs):
+        tenant_name = self.tenant_name
+
+        @wraps(func)
+        def in_tenant(*func_args, **func_kwargs):
+            with tenant_settings(tenant_name):
+                return func(*func_args, **func_kwargs)
+
+        return self.scheduler.add_job(in_tenant, *args, id=self.prefix + (id or uuid4().hex), **kwargs)
+
+    def get_jobs(self):
+        return [job for job in self.scheduler.get_jobs() if job.id.startswith(self.prefix)]
+
+    def add_listener(self, callback, mask):
+        tenant_name = self.tenant_name
+        prefix = self.prefix
+
+        # Listeners run in the scheduler thread, after the job and its tenant are done
+        def listener(event):
+            if (getattr(event, 'job_id', None) or '').startswith(prefix):
+                with tenant_settings(tenant_name):
+                    callback(event)
+
+        self.scheduler.add_listener(listener, mask)
+
+    def configure(self, **options):
+        # The shared scheduler keeps its own options
+        pass
+
+    def start(self):
+        if not self.scheduler.running:
+            self.scheduler.start()
+
+    def shutdown(self, wait=True):
+        # Only the host stops the shared scheduler
+        pass
+
+
+class TenantJobQueue(JobQueue):
+    """
+    JobQueue scheduling its jobs on a view of the shared scheduler
+    """
+    __slots__ = ()
+
+    def __init__(self, scheduler):
+        # Not JobQueue.__init__, which builds a scheduler of its own
+        self._dispatcher = None
+        self.logger = getLogger(self.__class__.__name__)
+        self.scheduler = scheduler
+        self.scheduler.add_listener(self._update_persistence, mask=EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        self.scheduler.add_listener(self._dispatch_error, EVENT_JOB_ERROR)
+
+
+class TenantDispatcher(Dispatcher):
+    """
+    Dispatcher processing every update with its tenant active
+    """
+    __slots__ = ('tenant',)
+
+    def process_update(self, update):
+        with self.tenant.activate():
+            super().process_update(update)
+
+
+class Tenant:
+    """
+    A hosted bot with its dispatcher and the moderation state which belongs to it alone
+    """
+
+    def __init__(self, name, dispatcher, notify, updater=None):
+        self.name = name
+        self.dispatcher = dispatcher
+        self.updater = updater
+        self.bot = dispatcher.bot
+        self.job_queue = dispatcher.job_queue
+        self.cleaner = MessageCleaner()
+        self.pending_captchas = PendingCaptchas()
+        self.pending_join_requests = PendingCaptchas()
+        self.approved_joins = ApprovedJoins()
+        self.errors = ErrorAggregator(notify)
+        with self.activate():
+            # On the connection of the persistence, the same database
+            store = BroadcastStore(get_persistence_path(), *dispatcher.persistence.share_connection())
+            self.broadcasts = BroadcastEngine(store, notify)
+            self.reputation = ReputationStore.load(get_reputation_path())
+            self.moderation_events = EventBuffer.load(get_events_path())
+        dispatcher.tenant = self
+        tenants[name] = self
+
+    def activate(self):
+        """
+        Makes this the tenant of the current thread until the block ends
+        """
+        return tenant_settings(self.name)
+
+
+class TenantHost:
+    """
+    The bots of this process, sharing one connection pool, one scheduler and one webhook server
+    """
+
+    def __init__(self, con_pool_size, notify, router=None, workers=TENANT_WORKERS):
+        self.request = TunedRequest(con_pool_size)
+        self.scheduler = BackgroundScheduler(timezone=pytz.utc)
+        self.notify = notify
+        self.router = router
+        self.workers = workers
+        self.tenants = {}
+        self.httpd = None
+        self.running = False
+        self.is_idle = False
+        self._threads = []
+        self._lock = Lock()
+
+    def add(self, name, token):
+        """
+        Adds a bot, with the Bot API urls and database of its tenant settings
+        :param name: the tenant name
+        :param token: the bot token
+        :return: the Tenant
+        """
+        with tenant_settings(name):
+            bot = build_bot(token, None, base_url=get_bot_api_url(), base_file_url=get_bot_api_file_url(),
+                            request=self.request, router=self.router)
+            job_queue = TenantJobQueue(SchedulerView(self.scheduler, name))
+            dispatcher = TenantDispatcher(bot, Queue(), workers=self.workers, job_queue=job_queue,
+                                          persistence=SQLitePersistence(get_persistence_path()))
+        job_queue.set_dispatcher(dispatcher)
+        tenant = self.tenants[name] = Tenant(name, dispatcher, self.notify, Updater(dispatcher=dispatcher, workers=None))
+        return tenant
+
+    def run_repeating(self, func, interval):
+        """
+        Runs a function every interval seconds on the shared scheduler, outside of any tenant
+        :param func: the function, called without arguments
+        :param interval: the interval in seconds
+        """
+        self.scheduler.add_job(func, 'interval', seconds=interval, name=func.__name__)
+
+    def start_polling(self):
+        """
+        Starts polling the updates of every bot
+        """
+        self.running = True
+        for tenant in self.tenants.values():
+            tenant.updater.start_polling()
+
+    def start_webhooks(self, listen, port, inline_reply=False):
+        """
+        Serves the webhooks of every bot on one port, each on the path of its token,
+        and registers them with Telegram
+        :param listen: the address to listen on
+        :param port: the port
+        :param inline_reply: if a handler may answer in the webhook response
+        """
+        self.running = True
+        webhook_reply.install(router=self.router, inline_reply=inline_reply)
+        app = webhook_reply.MultiBotWebhookApp({f'/{tenant.bot.token}': (tenant.bot, tenant.dispatcher.update_queue)
+                                                for tenant in self.tenants.values()})
+        self.httpd = WebhookServer(listen, port, app, None)
+        ready = Event()
+        self._start_thread(self.httpd.serve_forever, 'webhooks', ready=ready)
+        ready.wait()
+
+        self.scheduler.start()
+        for tenant in self.tenants.values():
+            # The Updater only stops the dispatcher, started here instead of by start_webhook
+            tenant.updater.running = True
+            self._start_thread(tenant.dispatcher.start, f'{tenant.name}-dispatcher')
+            with tenant.activate():
+                tenant.bot.set_webhook(url=get_bot_url())
+
+    def stop(self):
+        """
+        Stops every bot, the webhook server and the shared scheduler,
+        writing and closing the persistent data of every bot
+        """
+        with self._lock:
+            if not self.running:
+                return
+            self.running = False
+        if self.httpd:
+            self.httpd.shutdown()
+        for tenant in self.tenants.values():
+            tenant.updater.stop()
+            tenant.dispatcher.update_persistence()
+            tenant.dispatcher.persistence.close()
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.request.stop()
+
+    def idle(self, stop_signals=(SIGINT, SIGTERM, SIGABRT)):
+        """
+        Blocks until one of the signals is received and stops every bot
+        :param stop_signals: the signals
+        """
+        for sig in stop_signals:
+            signal(sig, self._signal_handler)
+        self.is_idle = True
+        while self.is_idle:
+            time.sleep(1)
+
+    def _signal_handler(self, signum, frame):
+        self.is_idle = False
+        logger.info('Señal %s recibida, deteniendo los bots', signum)
+        self.stop()
+
+    def _start_thread(self, target, name, **kwargs):
+        thread = Thread(target=target, kwargs=kwargs, name=f'tenants-{name}')
+        thread.start()
+        self._threads.append(thread)
@@ -0,0 +1,107 @@
+"""
+Tuned HTTP transport for the Bot API: pooled keep-alive connections,
+per-method timeouts and streamed file downloads
+"""
+import shutil
+import socket
+from urllib import parse as urllib_parse
+
+from telegram.utils.helpers import is_local_file
+from telegram.utils.request import Request
+from telegram.vendor.ptb_urllib3.urllib3 import Timeout
+
+from apis.tgram.routing import RoutingBot
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+CONNECT_TIMEOUT = 5.0
+DEFAULT_TIMEOUT = 7
+METHOD_TIMEOUTS = {
+    'answerCallbackQuery': 5,
+    'deleteMessage': 5,
+    'deleteMessages': 10,
+    'getFile': 15,
+    'sendDocument': 60,
+    'setWebhook': 15,
+}
+DOWNLOAD_TIMEOUT = 120
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _option, _value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)):
+    if hasattr(socket, _option):
+        KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _option), _value))
+
+
+class TunedRequest(Request):
+    """
+    Request with TCP keep-alive on the pooled connections and a read timeout
+    chosen per Bot API method when the caller does not give one
+    """
+    __slots__ = ('method_timeouts',)
+
+    def __init__(self, con_pool_size, method_timeouts=None, default_timeout=DEFAULT_TIMEOUT):
+        super().__init__(con_pool_size=con_pool_size, connect_timeout=CONNECT_TIMEOUT, read_timeout=default_timeout)
+        self.method_timeouts = method_timeouts or METHOD_TIMEOUTS
+        pool_kw = getattr(self._con_pool, 'connection_pool_kw', None)
+        if pool_kw is not None:
+            options = {(level, name): value for level, name, value in pool_kw.get('socket_options') or []}
+            options.update({(level, name): value for level, name, value in KEEPALIVE_OPTIONS})
+            pool_kw['socket_options'] = [(level, name, value) for (level, name), value in options.items()]
+
+    def post(self, url, data, timeout=None):
+        if timeout is None:
+            timeout = self.method_timeouts.get(url.rsplit('/', 1)[-1])
+        return super().post(url, data, timeout=timeout)
+
+    def stream_to(self, url, path, timeout=DOWNLOAD_TIMEOUT):
+        """
+        Downloads a url to a file in chunks, without holding it in memory
+        :param url: the url
+        :param path: the destination path
+        :param timeout: the read timeout
+        """
+        response = self._con_pool.request('GET', url, preload_content=False,
+                                          timeout=Timeout(connect=CONNECT_TIMEOUT, read=timeout))
+        try:
+            if response.status != 200:
+                raise IOError(f'Error {response.status} al descargar el fichero')
+            with open(path, 'wb') as out:
+                shutil.copyfileobj(response, out, DOWNLOAD_CHUNK_SIZE)
+        finally:
+            response.release_conn()
+
+
+def build_bot(token, con_pool_size, base_url=None, base_file_url=None, request=None, router=None):
+    """
+    Builds a bot on the tuned transport
+    :param token: the bot token
+    :param con_pool_size: the connection pool size, ignored when a request is given
+    :param base_url: the Bot API url, for a self-hosted Bot API server
+    :param base_file_url: the Bot API file url, for a self-hosted Bot API server
+    :param request: a TunedRequest to share, a new one if not given
+    :param router: an UpdateRouter for the polled updates, every update is decoded if not given
+    :return: the bot
+    """
+    return RoutingBot(token, base_url=base_url, base_file_url=base_file_url,
+                      request=request or TunedRequest(con_pool_size), router=router)
+
+
+def download_document(bot, file_id, path):
+    """
+    Gets a file to disk. A self-hosted Bot API server in local mode already
+    has it on disk, so its path is returned without copying anything
+    :param bot: the bot
+    :param file_id: the Telegram file id
+    :param path: where to download it when it is remote
+    :return: the path of the file on disk
+    """
+    telegram_file = bot.get_file(file_id)
+    if is_local_file(telegram_file.file_path):
+        return telegram_file.file_path
+
+    split_url = urllib_parse.urlsplit(telegram_file.file_path)
+    url = urllib_parse.urlunsplit(split_url._replace(path=urllib_parse.quote(split_url.path)))
+    bot.request.stream_to(url, path)
+    return path
@@ -1,5 +1,6 @@
 from functools import wraps
 
+from apis.tgram.tenants import current_tenant
 from config.common import MARTIN
 from config.environments import get_admin_id, get_allowed_users
 
@@ -10,7 +11,6 @@ from config.log_config import getLogger
 logger = getLogger(__name__)
 
 main_bot = None
-BOT_TIMEOUT = 7
 MAX_ATTEMPTS = 10
 
 
@@ -20,7 +20,12 @@ def set_bot(input_bot):
 
 
 def get_bot():
-    global main_bot
+    """
+    Returns the bot of the tenant being handled, or the one set with set_bot outside of any tenant
+    """
+    tenant = current_tenant()
+    if tenant:
+        return tenant.bot
     return main_bot
 
 
@@ -43,10 +48,9 @@ def reply_chat(chat_id, message, msg_edit=None, *args, **kwargs):
                 if msg_edit:
                     result = get_bot().edit_message_text(message, chat_id=chat_id,
                                                          message_id=msg_edit.message_id,
-                                                         timeout=BOT_TIMEOUT, *args, **kwargs)
+                                                         *args, **kwargs)
                 else:
-                    result = get_bot().send_message(chat_id, message,
-                                                    timeout=BOT_TIMEOUT, *args, **kwargs)
+                    result = get_bot().send_message(chat_id, message, *args, **kwargs)
                 exit_condition = True
                 return result
             except (TimedOut, NetworkError) as e:
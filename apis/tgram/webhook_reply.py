@@ -0,0 +1,133 @@
+"""
+Answering one Bot API call directly in the webhook HTTP response.
+
+Telegram accepts a method call as the body of the webhook response, which saves
+a network round trip. While the webhook request of an update is open, the first
+cheap fire-and-forget call of its handler goes in the response instead of a request.
+The same webhook handler drops the updates its router does not want before decoding them,
+and one app can serve the webhooks of many bots, each on its own path.
+"""
+import asyncio
+import json
+from concurrent.futures import Future
+from threading import Lock
+
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookHandler
+import tornado.web
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+INLINE_METHODS = frozenset(('answerCallbackQuery', 'deleteMessage', 'sendMessage'))
+REPLY_WAIT_SECONDS = 0.5
+
+_slots = {}
+_lock = Lock()
+_router = None
+_inline_reply = False
+
+
+class _ReplySlot:
+    __slots__ = ('future', 'open')
+
+    def __init__(self):
+        self.future = Future()
+        self.open = True
+
+
+def call(bot, update, method, **params):
+    """
+    Calls a Bot API method, in the webhook response of the update when possible
+    :param bot: the bot
+    :param update: the update being handled
+    :param method: the Bot API method name, eg. answerCallbackQuery
+    :param params: the method parameters
+    :return: True if it went in the webhook response, the API result otherwise
+    """
+    if method in INLINE_METHODS and update is not None:
+        with _lock:
+            slot = _slots.get((bot.token, update.update_id))
+            if slot and slot.open:
+                slot.open = False
+                slot.future.set_result(dict(params, method=method))
+                return True
+    return bot._post(method, params)
+
+
+def _open_slot(key):
+    slot = _ReplySlot()
+    with _lock:
+        _slots[key] = slot
+    return slot
+
+
+def _close_slot(key, slot):
+    with _lock:
+        # A retried delivery of the same update may have replaced it with its own slot
+        if _slots.get(key) is slot:
+            del _slots[key]
+        slot.open = False
+    return slot.future.result() if slot.future.done() else None
+
+
+class InlineReplyWebhookHandler(WebhookHandler):
+    """
+    Webhook handler which drops the updates no route wants, and waits a little for
+    the handler of a callback query to claim the response, sending the claimed call as its body
+    """
+
+    async def post(self):
+        self.logger.debug('Webhook triggered')
+        self._validate_post()
+        data = json.loads(self.request.body.decode())
+        self.set_status(200)
+        if _router and not _router.wants(data):
+            return
+        update = Update.de_json(data, self.bot)
+        if not update:
+            return
+        if isinstance(self.bot, ExtBot):
+            self.bot.insert_callback_data(update)
+
+        # Only callback queries are answered first thing by their handler
+        # Update ids are only unique per bot
+        key = (self.bot.token, update.update_id)
+        slot = _open_slot(key) if _inline_reply and update.callback_query else None
+        self.update_queue.put(update)
+        if slot is None:
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(slot.future)), REPLY_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        method_call = _close_slot(key, slot)
+        if method_call:
+            self.write(json.dumps(method_call))
+
+
+class MultiBotWebhookApp(WebhookAppClass):
+    """
+    Webhook app of many bots, routing each request by its path to the bot and update queue of that path
+    """
+
+    def __init__(self, routes):
+        handlers = [(rf"{webhook_path}/?", InlineReplyWebhookHandler, {"bot": bot, "update_queue": update_queue})
+                    for webhook_path, (bot, update_queue) in routes.items()]
+        tornado.web.Application.__init__(self, handlers)
+
+
+def install(router=None, inline_reply=False):
+    """
+    Sets up the webhook handler of MultiBotWebhookApp
+    :param router: the UpdateRouter of the incoming updates, every update is decoded if not given
+    :param inline_reply: if a handler may answer in the webhook response
+    """
+    global _router, _inline_reply
+    _router = router
+    _inline_reply = inline_reply
+    if inline_reply:
+        logger.info('Respuestas en línea del webhook activadas')
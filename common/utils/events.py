@@ -0,0 +1,161 @@
+"""
+Ring buffer of moderation events stored column by column in numpy arrays,
+so statistics over millions of events are a few vectorized operations
+"""
+import os
+import time
+from threading import Lock
+
+import numpy as np
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+EVENTS_CAPACITY = 1 << 20
+
+JOIN = 0
+CAPTCHA_SHOWN = 1
+PASSED = 2
+FAILED = 3
+TIMEOUT_BAN = 4
+BOT_BAN = 5
+KNOWN_BAN = 6
+EVENT_NAMES = ('join', 'captcha', 'passed', 'failed', 'timeout_ban', 'bot_ban', 'known_ban')
+
+
+class EventBuffer:
+    """
+    The last capacity moderation events, with their time, chat, user, kind and
+    latency in milliseconds (NaN when it does not apply). Once full, every new
+    event overwrites the oldest one
+    """
+
+    def __init__(self, capacity=EVENTS_CAPACITY, path=None):
+        self.path = path
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.chats = np.zeros(capacity, dtype=np.int64)
+        self.users = np.zeros(capacity, dtype=np.int64)
+        self.kinds = np.zeros(capacity, dtype=np.int8)
+        # Only the recorded slots are read and every record writes its latency, so zeros do:
+        # their pages are only committed as the events arrive, which keeps an idle bot small
+        self.latencies = np.zeros(capacity, dtype=np.float32)
+        self.recorded = 0
+        self._lock = Lock()
+        self._changed = False
+
+    @classmethod
+    def load(cls, path, capacity=EVENTS_CAPACITY):
+        """
+        Loads a buffer from its snapshot, or returns an empty one if there is none
+        :param path: the snapshot path
+        :param capacity: the capacity of the buffer
+        :return: the EventBuffer
+        """
+        buffer = cls(capacity, path)
+        if not path or not os.path.exists(path):
+            return buffer
+        try:
+            with np.load(path) as snapshot:
+                times = snapshot['times'][-capacity:]
+                count = len(times)
+                buffer.times[:count] = times
+                buffer.chats[:count] = snapshot['chats'][-capacity:]
+                buffer.users[:count] = snapshot['users'][-capacity:]
+                buffer.kinds[:count] = snapshot['kinds'][-capacity:]
+                buffer.latencies[:count] = snapshot['latencies'][-capacity:]
+                buffer.recorded = count
+        except (OSError, ValueError, KeyError):
+            logger.exception('No se pudieron cargar los eventos de moderación')
+            return cls(capacity, path)
+        return buffer
+
+    def record(self, kind, chat_id, user_id, latency=float('nan')):
+        """
+        Records an event
+        :param kind: the event kind, eg. PASSED
+        :param chat_id: the chat id
+        :param user_id: the user id
+        :param latency: the latency of the event in milliseconds, if it has one
+        """
+        with self._lock:
+            index = self.recorded % self.capacity
+            self.times[index] = time.time()
+            self.chats[index] = chat_id
+            self.users[index] = user_id
+            self.kinds[index] = kind
+            self.latencies[index] = latency
+            self.recorded += 1
+            self._changed = True
+
+    def __len__(self):
+        return min(self.recorded, self.capacity)
+
+    def columns(self, since=None):
+        """
+        Copies the recorded events, oldest first
+        :param since: only the events after this timestamp, all of them if not given
+        :return: a (times, chats, users, kinds, latencies) tuple of arrays
+        """
+        with self._lock:
+            # The older events go from the write position to the end, the newer ones from the start.
+            # Times only go forwards within each part, so the window is a suffix of each one
+            if self.recorded <= self.capacity:
+                parts = [slice(0, 0), slice(0, self.recorded)]
+            else:
+                start = self.recorded % self.capacity
+                parts = [slice(start, self.capacity), slice(0, start)]
+            if since is not None:
+                parts = [slice(part.start + np.searchsorted(self.times[part], since), part.stop) for part in parts]
+            return tuple(np.concatenate([column[part] for part in parts])
+                         for column in (self.times, self.chats, self.users, self.kinds, self.latencies))
+
+    def stats(self, since=None, chat_ids=None):
+        """
+        Computes the events per chat and kind and the answer latency percentiles
+        :param since: only the events after this timestamp, all of them if not given
+        :param chat_ids: only the events of these chats, every chat if not given
+        :return: a list of dicts, one per chat, with a count per event name and
+            the p50 and p95 of the time users took to answer, in milliseconds
+        """
+        _, chats, _, kinds, latencies = self.columns(since)
+        if chat_ids is not None:
+            selected = np.isin(chats, np.asarray(chat_ids, dtype=np.int64))
+            chats, kinds, latencies = chats[selected], kinds[selected], latencies[selected]
+        if not len(chats):
+            return []
+
+        chat_ids, chat_index = np.unique(chats, return_inverse=True)
+        counts = np.bincount(chat_index * len(EVENT_NAMES) + kinds, minlength=len(chat_ids) * len(EVENT_NAMES))
+        counts = counts.reshape(len(chat_ids), len(EVENT_NAMES))
+
+        # Answer latencies grouped by chat, each group a contiguous slice
+        answered = np.isin(kinds, (PASSED, FAILED)) & ~np.isnan(latencies)
+        order = np.argsort(chat_index[answered], kind='stable')
+        sorted_latencies = latencies[answered][order]
+        bounds = np.searchsorted(chat_index[answered][order], np.arange(len(chat_ids) + 1))
+
+        result = []
+        for i, chat_id in enumerate(chat_ids):
+            chat_latencies = sorted_latencies[bounds[i]:bounds[i + 1]]
+            stats = {'chat_id': int(chat_id)}
+            stats.update({name: int(count) for name, count in zip(EVENT_NAMES, counts[i])})
+            p50, p95 = np.percentile(chat_latencies, (50, 95)) if len(chat_latencies) else (None, None)
+            stats['answer_p50_ms'] = None if p50 is None else float(p50)
+            stats['answer_p95_ms'] = None if p95 is None else float(p95)
+            result.append(stats)
+        return result
+
+    def snapshot(self):
+        """
+        Writes the buffer to its path if anything was recorded since the last snapshot
+        """
+        if not self.path or not self._changed:
+            return
+        self._changed = False
+        times, chats, users, kinds, latencies = self.columns()
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'wb') as snapshot:
+            np.savez(snapshot, times=times, chats=chats, users=users, kinds=kinds, latencies=latencies)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,130 @@
+"""
+Cross-chat reputation of users: who already passed a captcha
+and who was banned, kept in compact structures and snapshotted to disk
+"""
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from config.log_config import getLogger
+
+logger = getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'REP3'
+SNAPSHOT_HEADER = struct.Struct('<4sQQ')  # magic, verified count, banned count
+# Older snapshots, which had a Bloom filter of the banned ids after the header
+BLOOM_SNAPSHOT_HEADERS = {
+    b'REP1': struct.Struct('<4sQIQQ'),  # magic, bloom bits, bloom hashes, bloom items, verified count
+    b'REP2': struct.Struct('<4sQIQQQ'),  # the same and the banned count
+}
+
+
+class SortedIdSet:
+    """
+    Set of ints stored as a sorted array of 8 bytes per id
+    """
+
+    def __init__(self, values=None):
+        self.array = array('q', sorted(set(values or ())))
+
+    def add(self, value):
+        index = bisect_left(self.array, value)
+        if index == len(self.array) or self.array[index] != value:
+            self.array.insert(index, value)
+
+    def __contains__(self, value):
+        index = bisect_left(self.array, value)
+        return index < len(self.array) and self.array[index] == value
+
+    def __len__(self):
+        return len(self.array)
+
+
+class ReputationStore:
+    """
+    Verified and banned users shared by every chat the bot moderates
+    """
+
+    def __init__(self, path=None, verified=None, banned=None):
+        self.path = path
+        self.verified = verified or SortedIdSet()
+        self.banned = banned or SortedIdSet()
+        self._lock = Lock()
+        self._changed = False
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a store from its snapshot, or returns an empty one if there is none
+        or it is not valid
+        :param path: the snapshot path
+        :return: the ReputationStore
+        """
+        if not path or not os.path.exists(path):
+            return cls(path)
+        try:
+            with open(path, 'rb') as snapshot:
+                data = snapshot.read()
+            return cls._from_snapshot(path, data)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning('No se pudo cargar la reputación de usuarios de %s, se empieza vacía: %s', path, e)
+            return cls(path)
+
+    @classmethod
+    def _from_snapshot(cls, path, data):
+        magic = data[:4]
+        if magic == SNAPSHOT_MAGIC:
+            _, verified_count, banned_count = SNAPSHOT_HEADER.unpack_from(data)
+            offset = SNAPSHOT_HEADER.size
+        elif magic in BLOOM_SNAPSHOT_HEADERS:
+            # The Bloom filter is skipped. Without exact banned ids, REP1 users banned before are challenged again
+            header = BLOOM_SNAPSHOT_HEADERS[magic].unpack_from(data)
+            bits, verified_count = header[1], header[4]
+            banned_count = header[5] if len(header) > 5 else 0
+            offset = BLOOM_SNAPSHOT_HEADERS[magic].size + (bits + 7) // 8
+        else:
+            raise ValueError('no es una instantánea de reputación')
+
+        verified = SortedIdSet()
+        banned = SortedIdSet()
+        sizes = (verified_count * verified.array.itemsize, banned_count * banned.array.itemsize)
+        if len(data) != offset + sum(sizes):
+            raise ValueError(f'tamaño {len(data)} en vez de {offset + sum(sizes)} bytes')
+
+        verified.array.frombytes(data[offset:offset + sizes[0]])
+        offset += sizes[0]
+        banned.array.frombytes(data[offset:offset + sizes[1]])
+        return cls(path, verified, banned)
+
+    def is_verified(self, user_id):
+        return user_id in self.verified
+
+    def is_banned(self, user_id):
+        return user_id in self.banned
+
+    def mark_verified(self, user_id):
+        with self._lock:
+            self.verified.add(user_id)
+            self._changed = True
+
+    def mark_banned(self, user_id):
+        with self._lock:
+            self.banned.add(user_id)
+            self._changed = True
+
+    def snapshot(self):
+        """
+        Writes the store to its path if anything changed since the last snapshot
+        """
+        if not self.path or not self._changed:
+            return
+        with self._lock:
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self.verified), len(self.banned))
+            data = header + self.verified.array.tobytes() + self.banned.array.tobytes()
+            self._changed = False
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'wb') as snapshot:
+            snapshot.write(data)
+        os.replace(temp_path, self.path)
@@ -1,11 +1,25 @@
 import os
 
 MARTIN = 13333606
+ROOT_PROJECT = os.path.dirname(os.path.dirname(__file__))
 
 COMMON_SETTINGS = {
     'LIST_OF_ADMINS': [MARTIN, ],
     'PINNED_MESSAGE': 'https://t.me/magicarena/80123',
     'GITHUB_TOKEN': os.environ.get('GITHUB_TOKEN'),
+    'UPDATE_LOG_PATH': os.environ.get('UPDATE_LOG_PATH'),
+    'PERSISTENCE_PATH': os.environ.get('PERSISTENCE_PATH', os.path.join(ROOT_PROJECT, 'bot_data.sqlite3')),
+    'BOT_API_URL': os.environ.get('BOT_API_URL'),
+    'BOT_API_FILE_URL': os.environ.get('BOT_API_FILE_URL'),
+    'WEBHOOK_REPLY': os.environ.get('WEBHOOK_REPLY', ''),
+    'LANE_SIZES': {'moderation': 8, 'interactive': 4, 'bulk': 2},
+    'REPUTATION_PATH': os.environ.get('REPUTATION_PATH', os.path.join(ROOT_PROJECT, 'reputation.bin')),
+    'EVENTS_PATH': os.environ.get('EVENTS_PATH', ''),
+    'CAPTCHA_TIMEOUT_SECONDS': 60,
+    'CHALLENGE_SETS': {},
+    'CHAT_CHALLENGE_SETS': {},
+    'ANNOUNCEMENT_TIME': os.environ.get('ANNOUNCEMENT_TIME', ''),
+    'ANNOUNCEMENT_DAYS': os.environ.get('ANNOUNCEMENT_DAYS', '0'),
 }
 
 
@@ -1,5 +1,11 @@
+import datetime as dt
+import json
 import os
-from config.common import COMMON_SETTINGS, get_active_env
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import MappingProxyType
+
+from config.common import COMMON_SETTINGS, ROOT_PROJECT, get_active_env
 from config.log_config import getLogger
 
 
@@ -20,11 +26,204 @@ def get_config_path():
     return os.path.dirname(__file__)
 
 
-# We must remove this VALUES and use an env variable-based config
-VALUES = {}
-VALUES.update(COMMON_SETTINGS)
+CONFIG_FILE = os.environ.get('CONFIG_FILE', os.path.join(ROOT_PROJECT, 'settings.json'))
+CONFIG_POLL_SECONDS = 5
+DEFAULT_TENANT = 'default'
+MEMORY_DATABASE = ':memory:'
+# Files each tenant keeps apart, named after it unless the tenant sets its own
+TENANT_PATHS = ('PERSISTENCE_PATH', 'REPUTATION_PATH', 'EVENTS_PATH')
+
+_config_listeners = []
+_config_checks = []
+# The tenant whose settings the getters read, None for the process-wide ones
+_tenant = ContextVar('tenant', default=None)
+# Settings being checked before a reload, read by the getters instead of the current ones
+_candidate = ContextVar('candidate_config', default=None)
+
+
+def _load_overrides(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as config_file:
+        return json.load(config_file)
+
+
+def _settings(base, overrides):
+    values = dict(base)
+    values.update(overrides)
+    values['ALLOWED_USERS'] = frozenset(values['LIST_OF_ADMINS'])
+    values['CHAT_CHALLENGE_SETS'] = MappingProxyType({int(chat_id): tuple(names) for chat_id, names
+                                                      in values.get('CHAT_CHALLENGE_SETS', {}).items()})
+    return values
+
+
+def _tenant_path(path, name):
+    if not path or path == MEMORY_DATABASE:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{name}{extension}'
+
+
+def _snapshot(overrides):
+    """
+    Builds an immutable settings snapshot: the common settings, then the
+    environment ones, then the overrides from the config file.
+    Each tenant in TENANTS gets a snapshot of its own with its overrides on top,
+    and a database, reputation and events file of its own unless it sets them
+    """
+    base = {}
+    base.update(COMMON_SETTINGS)
+    base.update(SETTINGS)
+    base.update(overrides)
+    tenant_overrides = base.pop('TENANTS', None) or {}
+
+    tenants = {}
+    for name, tenant in tenant_overrides.items():
+        paths = {key: _tenant_path(base.get(key), name) for key in TENANT_PATHS}
+        tenant_values = _settings(base, dict(paths, **tenant))
+        tenant_values['TENANTS'] = MappingProxyType({})
+        tenants[name] = MappingProxyType(tenant_values)
+
+    values = _settings(base, {})
+    values['TENANTS'] = MappingProxyType(tenants)
+    return MappingProxyType(values)
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Replaced as a whole on every reload, so readers never need a lock
+VALUES = _snapshot(_load_overrides(CONFIG_FILE))
+_config_signature = _file_signature(CONFIG_FILE)
+_rejected_signature = None
+
+
+def _keep_running_tenants(values, previous):
+    """
+    Keeps the hosted bots of a reloaded snapshot as they are running, as adding, removing
+    or renaming them needs a restart: the ones gone from TENANTS keep their previous settings
+    and the new ones are left out
+    """
+    running = previous['TENANTS']
+    tenants = values['TENANTS']
+    for name in running.keys() & tenants.keys():
+        if tenants[name].get('TELEGRAM_BOT_TOKEN') != running[name].get('TELEGRAM_BOT_TOKEN'):
+            logger.warning('El token del bot %s ha cambiado, se aplicará al reiniciar', name)
+    if tenants.keys() == running.keys():
+        return values
+
+    for name in running.keys() - tenants.keys():
+        logger.warning('El bot %s ya no está en TENANTS, mantiene su configuración hasta reiniciar', name)
+    for name in tenants.keys() - running.keys():
+        logger.warning('El bot %s se ha añadido a TENANTS, se iniciará al reiniciar', name)
+    values = dict(values)
+    values['TENANTS'] = MappingProxyType({name: tenants.get(name, tenant) for name, tenant in running.items()})
+    return MappingProxyType(values)
+
+
+def reload_config():
+    """
+    Reloads the settings if the config file changed since the last load,
+    and calls the listeners with the new snapshot
+    :return: True if the settings were reloaded
+    """
+    global VALUES, _config_signature, _rejected_signature
+    signature = _file_signature(CONFIG_FILE)
+    if signature == _config_signature:
+        return False
+    try:
+        values = _snapshot(_load_overrides(CONFIG_FILE))
+        _check(values)
+    except (OSError, ValueError, KeyError, AttributeError, TypeError):
+        # Parsed again on the next poll, as it may have been read halfway through a write,
+        # but only logged once per version of the file
+        if signature != _rejected_signature:
+            logger.exception('Configuración no válida en %s, se mantiene la anterior', CONFIG_FILE)
+        _rejected_signature = signature
+        return False
+
+    _config_signature = signature
+    values = _keep_running_tenants(values, VALUES)
+    VALUES = values
+    logger.info('Configuración recargada de %s', CONFIG_FILE)
+    for listener in _config_listeners:
+        try:
+            listener(values)
+        except Exception:
+            logger.exception('Error al aplicar la nueva configuración')
+    return True
+
+
+def on_config_change(listener):
+    """
+    Registers a function to call with the new settings after every reload
+    :param listener: the function
+    """
+    _config_listeners.append(listener)
+
+
+def on_config_check(check):
+    """
+    Registers a function to call before every reload, with the getters reading the new settings.
+    It builds what depends on them and raises if they are not valid, which rejects the reload
+    :param check: the function, called without arguments
+    """
+    _config_checks.append(check)
+
+
+def _check(values):
+    token = _candidate.set(values)
+    try:
+        for check in _config_checks:
+            check()
+    finally:
+        _candidate.reset(token)
 
-VALUES.update(SETTINGS)
+
+def _values():
+    name = _tenant.get()
+    values = _candidate.get() or VALUES
+    if name is None:
+        return values
+    return values['TENANTS'].get(name, values)
+
+
+@contextmanager
+def tenant_settings(name):
+    """
+    Makes the getters read the settings of a tenant in the current thread, until the block ends
+    :param name: the tenant name
+    """
+    token = _tenant.set(name)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def get_tenant_name():
+    """
+    Returns the tenant whose settings the getters read in the current thread
+    :return: the tenant name, None outside of any tenant
+    """
+    return _tenant.get()
+
+
+def get_tenants():
+    """
+    Returns the bots hosted by this process, from TENANTS in the config file.
+    Without it, the configured bot is the only one
+    :return: a dict from tenant name to its bot token
+    """
+    values = _candidate.get() or VALUES
+    if not values['TENANTS']:
+        return {DEFAULT_TENANT: values['TELEGRAM_BOT_TOKEN']}
+    return {name: tenant['TELEGRAM_BOT_TOKEN'] for name, tenant in values['TENANTS'].items()}
 
 
 def get_bot_url():
@@ -32,11 +231,12 @@ def get_bot_url():
     Returns the bot app name for Heroku deployment
     :return: the bot app name string
     """
+    values = _values()
     host = ''
-    if VALUES.get('HOST'):
-        host = f"{VALUES.get('HOST')}"
-    elif VALUES.get('BOT_APP_NAME'):
-        host = f"{VALUES.get('BOT_APP_NAME')}.herokuapp.com"
+    if values.get('HOST'):
+        host = f"{values.get('HOST')}"
+    elif values.get('BOT_APP_NAME'):
+        host = f"{values.get('BOT_APP_NAME')}.herokuapp.com"
 
     return f'https://{host}/{get_bot_token()}'
 
@@ -46,7 +246,23 @@ def get_bot_token():
     Returns the configured bot token
     :return: the bot token for the active environment
     """
-    return VALUES['TELEGRAM_BOT_TOKEN']
+    return _values()['TELEGRAM_BOT_TOKEN']
+
+
+def get_bot_api_url():
+    """
+    Returns the Bot API url, set when using a self-hosted Bot API server
+    :return: the url (eg. http://localhost:8081/bot) or None for the cloud Bot API
+    """
+    return _values().get('BOT_API_URL')
+
+
+def get_bot_api_file_url():
+    """
+    Returns the Bot API file url, set when using a self-hosted Bot API server
+    :return: the url (eg. http://localhost:8081/file/bot) or None for the cloud Bot API
+    """
+    return _values().get('BOT_API_FILE_URL')
 
 
 def get_github_token():
@@ -54,22 +270,108 @@ def get_github_token():
     Returns the configured bot token
     :return: the bot token for the active environment
     """
-    return VALUES['GITHUB_TOKEN']
+    return _values()['GITHUB_TOKEN']
 
 
 def get_allowed_users():
     """
     Returns the allowed users' ids for this bot
-    :return: the ids
+    :return: a frozenset of the ids
     """
-    return VALUES['LIST_OF_ADMINS']
+    return _values()['ALLOWED_USERS']
 
 
 def get_admin_id():
-    return VALUES['ADMIN_ID']
+    return _values()['ADMIN_ID']
+
+
+def get_update_log_path():
+    """
+    Returns the path of the recorded updates log, if recording is enabled
+    :return: the log path or None
+    """
+    return _values().get('UPDATE_LOG_PATH')
+
+
+def get_persistence_path():
+    """
+    Returns the path of the SQLite database with the persistent bot data
+    :return: the database path
+    """
+    return _values()['PERSISTENCE_PATH']
+
+
+def get_reputation_path():
+    """
+    Returns the path of the users' reputation snapshot
+    :return: the snapshot path, empty to keep it only in memory
+    """
+    return _values()['REPUTATION_PATH']
+
+
+def get_events_path():
+    """
+    Returns the path of the moderation events snapshot
+    :return: the snapshot path, empty to keep them only in memory
+    """
+    return _values().get('EVENTS_PATH', '')
+
+
+def get_announcement_schedule():
+    """
+    Returns when the pinned message is broadcast to every managed chat
+    :return: a (time in UTC, weekdays from 0 for Monday) tuple, None if it is not scheduled
+    """
+    values = _values()
+    if not values.get('ANNOUNCEMENT_TIME'):
+        return None
+    hour, minute = values['ANNOUNCEMENT_TIME'].split(':')
+    days = tuple(int(day) for day in str(values.get('ANNOUNCEMENT_DAYS', '0')).split(','))
+    return dt.time(int(hour), int(minute)), days
+
+
+def get_chat_challenge_sets():
+    """
+    Returns the captcha challenge sets of the chats which do not use the default one
+    :return: a mapping from chat id to a tuple of challenge set names
+    """
+    return _values()['CHAT_CHALLENGE_SETS']
+
+
+def get_challenge_sets():
+    """
+    Returns the captcha challenge sets defined in the config, besides the built-in ones
+    :return: a dict from set name to a dict with its prompt, decoys and answers
+    """
+    return _values().get('CHALLENGE_SETS', {})
+
+
+def get_captcha_timeout():
+    """
+    Returns how long a new member has to solve the captcha
+    :return: the timeout in seconds
+    """
+    return _values()['CAPTCHA_TIMEOUT_SECONDS']
+
+
+def get_lane_sizes():
+    """
+    Returns the number of threads of each execution lane
+    :return: a dict from lane name to its size
+    """
+    return _values()['LANE_SIZES']
+
+
+def webhook_reply_enabled():
+    """
+    Returns if the first cheap Bot API call of a handler may go in the webhook response
+    :return: True if enabled
+    """
+    return _values().get('WEBHOOK_REPLY', '').lower() in ('1', 'true', 'yes')
 
 
 def get_pinned_message():
-    if VALUES.get('PINNED_MESSAGE', '').strip():
-        return f"Para cualquier duda mira el mensaje anclado, por favor:\n\t {VALUES['PINNED_MESSAGE']} "
+    pinned_message = _values().get('PINNED_MESSAGE', '')
+    if pinned_message.strip():
+        return f"Para cualquier duda mira el mensaje anclado, por favor:\n\t {pinned_message} "
     return ''
@@ -0,0 +1,333 @@
+"""
+Local benchmarks of the bot internals.
+
+Usage:
+    python benchmarks.py
+"""
+import gc
+import io
+import itertools
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from threading import Thread
+
+import harness
+
+from apis.tgram.captcha import PendingCaptcha, PendingCaptchas
+from apis.tgram.challenges import ChallengeBank
+
+CHAT_ID = -1001234567890
+SUITE_SIZE = 300
+SUITE_ROUNDS = 3
+RUNNING_BOTS_SETTLE_SECONDS = 1
+_user_ids = itertools.count(200000000)
+
+
+def join_update(update_id, user_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'Grupo'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Usuario'},
+            'new_chat_members': [{'id': user_id, 'is_bot': False, 'first_name': 'Usuario'}],
+        },
+    }
+
+
+def callback_update(update_id, user_id, answer='leche'):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'chat_instance': 'benchmark', 'data': f'{answer},{user_id},Usuario',
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Usuario'},
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': CHAT_ID, 'type': 'supergroup'}, 'text': 'captcha'},
+        },
+    }
+
+
+def _process(dispatcher, data):
+    from telegram import Update
+
+    update = Update.de_json(data, dispatcher.bot)
+    start = time.perf_counter()
+    dispatcher.process_update(update)
+    return time.perf_counter() - start
+
+
+def captcha_join_benchmark(dispatcher, count=SUITE_SIZE):
+    """
+    Times the join path: restriction, captcha message and timeout scheduling
+    :param dispatcher: the harness dispatcher
+    :param count: how many joins
+    :return: the latency report
+    """
+    user_ids = [next(_user_ids) for _ in range(count)]
+    start = time.perf_counter()
+    latencies = [_process(dispatcher, join_update(i, user_id)) for i, user_id in enumerate(user_ids)]
+    return harness.latency_report('captcha_join', latencies, time.perf_counter() - start)
+
+
+def captcha_callback_benchmark(dispatcher, count=SUITE_SIZE):
+    """
+    Times the callback path of users answering their captcha
+    :param dispatcher: the harness dispatcher
+    :param count: how many answers
+    :return: the latency report
+    """
+    user_ids = [next(_user_ids) for _ in range(count)]
+    for i, user_id in enumerate(user_ids):
+        _process(dispatcher, join_update(i, user_id))
+    updates = [harness.press_drawn_answer(dispatcher, callback_update(count + i, user_id))
+               for i, user_id in enumerate(user_ids)]
+    start = time.perf_counter()
+    latencies = [_process(dispatcher, update) for update in updates]
+    return harness.latency_report('captcha_callback', latencies, time.perf_counter() - start)
+
+
+def challenge_draw_benchmark(count=SUITE_SIZE * 10):
+    """
+    Times drawing a captcha challenge and filling in its user
+    :param count: how many challenges
+    :return: the latency report
+    """
+    import main
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        draw_start = time.perf_counter()
+        main.challenge_bank.draw(CHAT_ID).markup(200000000 + i, 'Usuario')
+        latencies.append(time.perf_counter() - draw_start)
+    return harness.latency_report('challenge_draw', latencies, time.perf_counter() - start)
+
+
+def challenge_generation_rate(count=100000):
+    """
+    Measures how fast the challenge bank generates challenges
+    :param count: how many challenges
+    :return: the challenges generated per second
+    """
+    import main
+
+    challenge_set = main.challenge_bank.sets[main.challenge_bank.default_sets[0]]
+    start = time.perf_counter()
+    # The bank fills its pool on creation, and no draw goes below the refill threshold
+    bank = ChallengeBank([challenge_set], pool_size=count, refill_threshold=0)
+    for _ in range(count):
+        bank.draw(CHAT_ID)
+    return count / (time.perf_counter() - start)
+
+
+def logging_benchmark(count=SUITE_SIZE * 10):
+    """
+    Times log records going through the bot formatter
+    :param count: how many records
+    :return: the latency report
+    """
+    from config.log_config import formatter
+
+    stream_handler = logging.StreamHandler(io.StringIO())
+    stream_handler.setFormatter(formatter)
+    bench_logger = logging.getLogger('benchmark.logging')
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+    bench_logger.addHandler(stream_handler)
+    try:
+        latencies = []
+        start = time.perf_counter()
+        for i in range(count):
+            record_start = time.perf_counter()
+            bench_logger.info('New member detected %d', i)
+            latencies.append(time.perf_counter() - record_start)
+        return harness.latency_report('logging', latencies, time.perf_counter() - start)
+    finally:
+        bench_logger.removeHandler(stream_handler)
+
+
+def run_suite(rounds=SUITE_ROUNDS):
+    """
+    Runs every handler benchmark against the fake Bot API, keeping the best
+    round of each one to smooth out the noise of the machine
+    :param rounds: how many times each benchmark runs
+    :return: a dict from benchmark name to its latency report
+    """
+    from config.log_config import handlers
+
+    levels = [handler.level for handler in handlers]
+    for handler in handlers:
+        handler.setLevel(logging.ERROR)
+    api = harness.FakeBotApi().start()
+    try:
+        dispatcher = harness.make_dispatcher(api)
+        results = {}
+        for _ in range(rounds):
+            for report in (captcha_join_benchmark(dispatcher),
+                           captcha_callback_benchmark(dispatcher),
+                           challenge_draw_benchmark(),
+                           logging_benchmark()):
+                best = results.get(report['name'])
+                if not best or report['p95_ms'] < best['p95_ms']:
+                    results[report['name']] = report
+        return results
+    finally:
+        api.stop()
+        for handler, level in zip(handlers, levels):
+            handler.setLevel(level)
+
+
+def pending_captcha_memory(count=10000):
+    """
+    Measures the memory held per pending captcha record
+    :param count: how many pending captchas to register
+    :return: the bytes per pending captcha
+    """
+    names = [f'Usuario{i % 500}' for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    registry = PendingCaptchas()
+    for i in range(count):
+        registry.add(PendingCaptcha(-1001234567890, 100000000 + i, 50000 + i, names[i], 60))
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / count
+
+
+def legacy_captcha_memory(count=10000):
+    """
+    Measures the memory held per pending captcha when the job kwargs
+    keep the whole User and Message objects, as it used to be
+    :param count: how many pending captchas to register
+    :return: the bytes per pending captcha
+    """
+    from telegram import Bot, Message, User
+
+    bot = Bot(harness.FAKE_TOKEN)
+    chat = {'id': -1001234567890, 'type': 'supergroup', 'title': 'Grupo'}
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    kwargs = []
+    for i in range(count):
+        member = User(100000000 + i, f'Usuario{i % 500}', False, bot=bot)
+        message = Message.de_json({'message_id': 50000 + i, 'date': 1700000000, 'chat': chat,
+                                   'text': f'Hola Usuario{i % 500}, necesitamos comprobar que no eres un bot'}, bot)
+        kwargs.append({'member': member, 'chat_id': chat['id'], 'message': message})
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / count
+
+
+def _bot_token(i):
+    return f'{harness.FAKE_BOT_ID + i}:fake-token-for-local-runs'
+
+
+def _resident_memory():
+    """
+    Returns the resident memory of this process, its peak where there is no /proc
+    :return: the bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _start_hosted_bots(count):
+    import main
+    from apis.tgram.tenants import TENANT_CONNECTIONS, TenantHost
+    from apis.tgram.utils import admin_reply
+
+    host = TenantHost(count * TENANT_CONNECTIONS, admin_reply)
+    for i in range(count):
+        tenant = host.add(f'benchmark-{i}', _bot_token(i))
+        main.register_handlers(tenant.dispatcher)
+    # As start_webhooks does, without the webhook server
+    host.scheduler.start()
+    for tenant in host.tenants.values():
+        Thread(target=tenant.dispatcher.start, daemon=True).start()
+
+
+def _start_standalone_bots(count):
+    import main
+    from telegram.ext import Updater
+    from apis.tgram.persistence import SQLitePersistence
+    from apis.tgram.transport import build_bot
+    from config.environments import get_bot_api_file_url, get_bot_api_url
+
+    for i in range(count):
+        bot = build_bot(_bot_token(i), 8, base_url=get_bot_api_url(), base_file_url=get_bot_api_file_url())
+        updater = Updater(bot=bot, persistence=SQLitePersistence(':memory:'), workers=4)
+        main.register_handlers(updater.dispatcher)
+        updater.job_queue.start()
+        Thread(target=updater.dispatcher.start, daemon=True).start()
+
+
+def _measure_running_bots(hosted, count):
+    # Run in a process of its own: the dispatcher workers can't be stopped, so it ends with os._exit
+    import main  # noqa: F401, the process memory includes the bot code
+
+    gc.collect()
+    before = _resident_memory()
+    (_start_hosted_bots if hosted else _start_standalone_bots)(count)
+    time.sleep(RUNNING_BOTS_SETTLE_SECONDS)
+    gc.collect()
+    print(before, (_resident_memory() - before) // count, flush=True)
+    os._exit(0)
+
+
+def running_bot_memory(hosted, count=20):
+    """
+    Measures the resident memory of bots with every handler registered and their
+    dispatcher, workers and scheduler running, in a new process
+    :param hosted: True for bots hosted in a TenantHost, False for bots with their own
+    Updater, connection pool and scheduler, as it used to be with a process per bot
+    :param count: how many bots
+    :return: the bytes per bot and the bytes of the process before starting them
+    """
+    code = f'import benchmarks; benchmarks._measure_running_bots({hosted!r}, {count})'
+    api = harness.FakeBotApi().start()
+    try:
+        env = dict(os.environ, BOT_API_URL=api.base_url, BOT_API_FILE_URL=api.base_file_url)
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=env, stdout=subprocess.PIPE, check=True, text=True)
+    finally:
+        api.stop()
+    process, per_bot = map(int, result.stdout.split()[-2:])
+    return per_bot, process
+
+
+def print_suite(results):
+    for stats in results.values():
+        print(f"{stats['name']:>18}: {stats['throughput']:.1f}/s, p50 {stats['p50_ms']:.2f} ms, "
+              f"p95 {stats['p95_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms")
+
+
+def main():
+    print_suite(run_suite())
+    print(f'Desafíos: {challenge_generation_rate():.0f} generados/s')
+    print(f'Captcha pendiente: {pending_captcha_memory():.0f} bytes '
+          f'(antes {legacy_captcha_memory():.0f} bytes)')
+    hosted, _ = running_bot_memory(hosted=True)
+    standalone, process = running_bot_memory(hosted=False)
+    print(f'Bot alojado en marcha: {hosted / 1024:.0f} KiB '
+          f'(con su propio Updater {standalone / 1024:.0f} KiB, más {process / 2 ** 20:.0f} MiB de un proceso)')
+
+
+if __name__ == '__main__':
+    main()
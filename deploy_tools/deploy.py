@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import sys
@@ -18,6 +19,11 @@ CAND_VER = BASIC_VER + RELEASE_VER
 
 TARGET_BRANCH_NAME = 'main'
 
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baselines.json')
+BASELINE_METRICS = ('throughput', 'p95_ms')
+# Allowed relative worsening of p95 latency or throughput against the last tagged baseline
+PERF_THRESHOLD = float(os.environ.get('PERF_REGRESSION_THRESHOLD', '0.2'))
+
 
 def main():
     env = ''
@@ -39,6 +45,10 @@ def main():
     if env != 'dev':
         check_if_tag_exists(new_version)
 
+    perf_results = None
+    if env == 'production':
+        perf_results = check_performance()
+
     current_branch = os.popen('git symbolic-ref --short -q HEAD').read().strip()
 
     if 'y' not in input(f'\nConfirm pushing branch {current_branch.upper()} to {TARGET_BRANCH_NAME} for {env.upper()}? [y/n]: '):
@@ -46,7 +56,12 @@ def main():
         sys.exit(0)
 
     set_file_version(new_version)
-    os.system(f'git commit {version_file_path} -m "({new_version})" ')
+    commit_files = version_file_path
+    if perf_results:
+        save_baseline(new_version, perf_results)
+        os.system(f'git add {BASELINES_FILE}')
+        commit_files += f' {BASELINES_FILE}'
+    os.system(f'git commit {commit_files} -m "({new_version})" ')
     print('Commited version')
 
     deploy_branch_to(current_branch, env, new_version)
@@ -187,6 +202,110 @@ def check_if_tag_exists(new_version):
         sys.exit(0)
 
 
+def check_performance():
+    """
+    Runs the handler benchmark suite and aborts the deployment when it regressed
+    beyond PERF_THRESHOLD from the baseline of the last tagged version, or when
+    a memory benchmark is not below its reference
+    :return: the benchmark results
+    """
+    from benchmarks import run_suite, print_suite
+
+    print('Running benchmarks...')
+    results = run_suite()
+    print_suite(results)
+
+    baselines = load_baselines()
+    previous_version = latest_baseline_version(baselines)
+    regressions = find_memory_regressions()
+    if previous_version:
+        regressions += find_regressions(baselines[previous_version], results, PERF_THRESHOLD)
+    else:
+        print('No baseline to compare with')
+
+    if regressions:
+        print(f'Performance regression against {previous_version or "the references"}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        print('Aborted')
+        sys.exit(-1)
+    if previous_version:
+        print(f'No performance regression against {previous_version}')
+    return results
+
+
+def load_baselines():
+    """
+    Reads the benchmark baselines stored per version
+    :return: a dict from version to its benchmark metrics
+    """
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE, 'r') as baselines_file:
+        return json.load(baselines_file)
+
+
+def latest_baseline_version(baselines):
+    """
+    Finds the newest version tag having a stored baseline
+    :param baselines: the stored baselines
+    :return: the version or None
+    """
+    tags = os.popen('git tag --sort=-creatordate').read().split()
+    for tag in tags:
+        if tag in baselines:
+            return tag
+    return None
+
+
+def find_regressions(baseline, results, threshold):
+    """
+    Compares benchmark results with a baseline
+    :param baseline: the baseline metrics per benchmark
+    :param results: the new benchmark reports
+    :param threshold: the allowed relative worsening
+    :return: a list with a description of every regression
+    """
+    regressions = []
+    for name, metrics in baseline.items():
+        current = results.get(name)
+        if not current:
+            continue
+        if current['p95_ms'] > metrics['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {metrics['p95_ms']:.2f} ms => {current['p95_ms']:.2f} ms")
+        if current['throughput'] < metrics['throughput'] * (1 - threshold):
+            regressions.append(f"{name}: {metrics['throughput']:.1f}/s => {current['throughput']:.1f}/s")
+    return regressions
+
+
+def find_memory_regressions():
+    """
+    Checks the memory benchmarks against their references
+    :return: a list with a description of every regression
+    """
+    from benchmarks import legacy_captcha_memory, pending_captcha_memory
+
+    regressions = []
+    compact, legacy = pending_captcha_memory(), legacy_captcha_memory()
+    if compact >= legacy:
+        regressions.append(f'pending captcha: {compact:.0f} bytes, not below {legacy:.0f} bytes of the full objects')
+    return regressions
+
+
+def save_baseline(version, results):
+    """
+    Stores the benchmark results as the baseline of a version
+    :param version: the version string
+    :param results: the benchmark reports
+    """
+    baselines = load_baselines()
+    baselines[version] = {name: {metric: round(report[metric], 3) for metric in BASELINE_METRICS}
+                          for name, report in results.items()}
+    with open(BASELINES_FILE, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+        baselines_file.write('\n')
+
+
 def set_file_version(version):
     """
     Updates the text file version line with the received version
@@ -0,0 +1,303 @@
+"""
+Local harness for running the bot handlers without Telegram:
+a fake Bot API server, a virtual clock job queue and latency statistics
+"""
+import datetime as dt
+import heapq
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from threading import Thread
+
+ROOT_PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_PROJECT not in sys.path:
+    sys.path.insert(0, ROOT_PROJECT)
+
+FAKE_BOT_ID = 123456
+FAKE_TOKEN = f'{FAKE_BOT_ID}:fake-token-for-local-runs'
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', FAKE_TOKEN)
+os.environ.setdefault('PERSISTENCE_PATH', ':memory:')
+os.environ.setdefault('REPUTATION_PATH', '')
+
+
+class FakeBotApi:
+    """
+    Minimal local Bot API server answering every method with a plausible result
+    """
+
+    def __init__(self, bot_id=FAKE_BOT_ID):
+        self.bot_id = bot_id
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self.file_content = b'contenido de prueba'
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/bot'
+
+    @property
+    def base_file_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/file/bot'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def result_for(self, method, params):
+        """
+        Builds the result object for a Bot API method call
+        :param method: the method name
+        :param params: the call parameters
+        :return: the result to send back
+        """
+        now = int(time.time())
+        if method == 'getMe':
+            return {'id': self.bot_id, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method in ('sendMessage', 'editMessageText', 'forwardMessage'):
+            chat_id = int(params.get('chat_id', 0))
+            return {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': now,
+                'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+                'text': params.get('text', ''),
+            }
+        if method == 'getFile':
+            return {'file_id': params.get('file_id'), 'file_unique_id': 'fake', 'file_path': 'documents/fake'}
+        return True
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = {}
+                api.calls[method] += 1
+                response = json.dumps({'ok': True, 'result': api.result_for(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def do_GET(self):
+                content = api.file_content
+                api.calls['download'] += 1
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class VirtualClock:
+    """
+    Clock which only moves when told to
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+
+class VirtualJob:
+    """
+    Job scheduled on a VirtualJobQueue, with the same removal api as telegram.ext.Job
+    """
+
+    def __init__(self, callback, name, kwargs, interval=None, context=None):
+        self.callback = callback
+        self.name = name
+        self.kwargs = kwargs
+        self.interval = interval
+        self.context = context
+        self.removed = False
+        self.job = self  # Handlers cancel through job.job.remove() as with APScheduler jobs
+
+    def remove(self):
+        self.removed = True
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class VirtualJobQueue:
+    """
+    Job queue driven by a VirtualClock, so timeouts such as the captcha one
+    expire in recorded time whatever the replay speed is
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._dispatcher = None
+        self._heap = []
+        self._counter = itertools.count()
+
+    def set_dispatcher(self, dispatcher):
+        self._dispatcher = dispatcher
+
+    def run_once(self, callback, when, context=None, name=None, job_kwargs=None):
+        job = VirtualJob(callback, name or callback.__name__, (job_kwargs or {}).get('kwargs', {}), context=context)
+        self._push(job, self.clock.now + _seconds(when))
+        return job
+
+    def run_repeating(self, callback, interval, first=None, last=None, context=None, name=None, job_kwargs=None):
+        job = VirtualJob(callback, name or callback.__name__, (job_kwargs or {}).get('kwargs', {}),
+                         interval=_seconds(interval), context=context)
+        self._push(job, self.clock.now + _seconds(first if first is not None else interval))
+        return job
+
+    def jobs(self):
+        return tuple(job for _, _, job in self._heap if not job.removed)
+
+    def get_jobs_by_name(self, name):
+        return tuple(job for job in self.jobs() if job.name == name)
+
+    def advance(self, until):
+        """
+        Moves the clock forward running every job due until then
+        :param until: the new virtual time
+        :return: the latencies in seconds of the jobs run
+        """
+        from telegram.ext import CallbackContext
+
+        latencies = []
+        while self._heap and self._heap[0][0] <= until:
+            due, _, job = heapq.heappop(self._heap)
+            if job.removed:
+                continue
+            self.clock.now = due
+            start = time.perf_counter()
+            with self._dispatcher.tenant.activate():
+                try:
+                    job.callback(CallbackContext.from_job(job, self._dispatcher), **job.kwargs)
+                except Exception as e:
+                    self._dispatcher.dispatch_error(None, e)
+            latencies.append(time.perf_counter() - start)
+            if job.interval:
+                self._push(job, due + job.interval)
+        self.clock.now = max(self.clock.now, until)
+        return latencies
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def _push(self, job, due):
+        heapq.heappush(self._heap, (due, next(self._counter), job))
+
+
+def _seconds(when):
+    if isinstance(when, dt.timedelta):
+        return when.total_seconds()
+    return float(when)
+
+
+def make_dispatcher(api, clock=None):
+    """
+    Builds the dispatcher of a tenant with every handler of the bot registered,
+    talking to the fake Bot API and using a virtual clock job queue
+    :param api: the running FakeBotApi
+    :param clock: the virtual clock, a new one if not given
+    :return: the dispatcher
+    """
+    import main
+    from apis.tgram.lanes import configure_lanes
+    from apis.tgram.persistence import SQLitePersistence
+    from apis.tgram.tenants import Tenant, TenantDispatcher
+    from apis.tgram.transport import build_bot
+    from apis.tgram.utils import admin_reply
+    from config.environments import DEFAULT_TENANT, get_lane_sizes
+
+    bot = build_bot(FAKE_TOKEN, 8, base_url=api.base_url, base_file_url=api.base_file_url)
+    job_queue = VirtualJobQueue(clock or VirtualClock())
+    # The dispatcher is never started, so its worker is never created: 1 only keeps
+    # PTB from warning that run_async callbacks need a worker thread
+    dispatcher = TenantDispatcher(bot, Queue(), workers=1, job_queue=job_queue,
+                                  persistence=SQLitePersistence(':memory:'))
+    job_queue.set_dispatcher(dispatcher)
+    Tenant(DEFAULT_TENANT, dispatcher, admin_reply)
+    # Inline lanes keep the runs deterministic and time the handlers themselves
+    configure_lanes({name: 0 for name in get_lane_sizes()})
+    main.register_handlers(dispatcher)
+    return dispatcher
+
+
+def press_drawn_answer(dispatcher, data):
+    """
+    Points a captcha answer pressed in a recorded or made up update at the answer of the challenge
+    drawn in this run, as the challenges are drawn again at random. Presses of decoys are kept
+    :param dispatcher: the harness dispatcher
+    :param data: the update JSON
+    :return: the update JSON
+    """
+    import main
+
+    query = data.get('callback_query')
+    parts = query.get('data', '').split(',', 2) if query else ()
+    if len(parts) != 3 or not parts[1].lstrip('-').isdigit():
+        return data
+    tenant = dispatcher.tenant
+    if query['message']['chat']['type'] == 'private':
+        chat_id, user_id, pending_captchas = int(parts[1]), query['from']['id'], tenant.pending_join_requests
+    else:
+        chat_id, user_id, pending_captchas = query['message']['chat']['id'], int(parts[1]), tenant.pending_captchas
+    pending = pending_captchas.get(chat_id, user_id)
+    if not pending or not main.challenge_bank.is_answer(chat_id, parts[0]):
+        return data
+    return dict(data, callback_query=dict(query, data=f'{pending.answer},{parts[1]},{parts[2]}'))
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """
+    Nearest-rank percentiles of some samples
+    :param samples: the samples
+    :param points: the percentiles wanted
+    :return: a dict from percentile to value, 0 for every one when there are no samples
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {point: 0.0 for point in points}
+    return {point: ordered[min(len(ordered) - 1, max(0, int(round(point / 100 * len(ordered))) - 1))]
+            for point in points}
+
+
+def latency_report(name, latencies, wall_seconds):
+    """
+    Summarizes a benchmark run
+    :param name: the run name
+    :param latencies: the latency samples in seconds
+    :param wall_seconds: the run total duration
+    :return: a dict with count, throughput and percentiles in milliseconds
+    """
+    pcts = percentiles(latencies)
+    return {
+        'name': name,
+        'count': len(latencies),
+        'throughput': len(latencies) / wall_seconds if wall_seconds else 0.0,
+        'p50_ms': pcts[50] * 1000,
+        'p95_ms': pcts[95] * 1000,
+        'p99_ms': pcts[99] * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+    }
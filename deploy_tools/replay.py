@@ -0,0 +1,90 @@
+"""
+Replays a recorded update log against the real handlers and a local fake Bot API.
+
+Usage:
+    python replay.py <updates.jsonl.gz> [--speed 1|10|max]
+
+Recorded time is kept by a virtual clock, so captcha timeouts expire after
+the captcha timeout of recorded time whatever the replay speed is.
+"""
+import argparse
+import time
+
+from harness import FakeBotApi, VirtualClock, make_dispatcher, latency_report, press_drawn_answer
+
+from apis.tgram.recorder import read_log
+from config.environments import get_captcha_timeout
+
+SPEEDS = ('1', '10', 'max')
+
+
+def replay(path, speed='max'):
+    """
+    Replays a recorded log
+    :param path: the log path
+    :param speed: the replay speed, '1', '10' or 'max'
+    :return: the reports for the update handlers and the jobs
+    """
+    from telegram import Update
+
+    factor = None if speed == 'max' else float(speed)
+    api = FakeBotApi().start()
+    clock = VirtualClock()
+    dispatcher = make_dispatcher(api, clock)
+    job_queue = dispatcher.job_queue
+
+    update_latencies = []
+    job_latencies = []
+    first_t = None
+    start = time.perf_counter()
+    try:
+        for t, data in read_log(path):
+            if first_t is None:
+                first_t = t
+            virtual_now = t - first_t
+            if factor:
+                delay = start + virtual_now / factor - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            job_latencies.extend(job_queue.advance(virtual_now))
+
+            update = Update.de_json(press_drawn_answer(dispatcher, data), dispatcher.bot)
+            update_start = time.perf_counter()
+            dispatcher.process_update(update)
+            update_latencies.append(time.perf_counter() - update_start)
+
+        # Let the pending captchas expire
+        job_latencies.extend(job_queue.advance(clock.now + get_captcha_timeout()))
+        wall_seconds = time.perf_counter() - start
+    finally:
+        api.stop()
+
+    return {
+        'speed': speed,
+        'updates': latency_report('updates', update_latencies, wall_seconds),
+        'jobs': latency_report('jobs', job_latencies, wall_seconds),
+        'api_calls': dict(api.calls),
+    }
+
+
+def print_report(report):
+    print(f"Velocidad: {report['speed']}")
+    for key in ('updates', 'jobs'):
+        stats = report[key]
+        print(f"{stats['name']:>8}: {stats['count']} en total, {stats['throughput']:.1f}/s, "
+              f"p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, "
+              f"p99 {stats['p99_ms']:.2f} ms, max {stats['max_ms']:.2f} ms")
+    for method, count in sorted(report['api_calls'].items()):
+        print(f'{method:>24}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a recorded update log')
+    parser.add_argument('log', help='the gzip update log written by UpdateRecorder')
+    parser.add_argument('--speed', choices=SPEEDS, default='max')
+    args = parser.parse_args()
+    print_report(replay(args.log, args.speed))
+
+
+if __name__ == '__main__':
+    main()
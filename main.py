@@ -4,7 +4,7 @@
 dependencies:
     pip3 install --upgrade python-telegram-bot
 
-This Bot uses the Updater class to handle the bot.
+This Bot uses a TenantHost to handle one or more bots, each with its own Updater.
 
 First, a few handler functions are defined. Then, those functions are passed to
 the Dispatcher and registered at their respective places.
@@ -14,27 +14,67 @@ bot.
 """
 import os
 import sys
-import random as rnd
+import time
+import warnings
 from threading import Thread
 
 import telegram
-from telegram import ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Updater, MessageHandler, CommandHandler, Filters, CallbackQueryHandler, CallbackContext, \
-    ConversationHandler
+from telegram import Chat, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import TelegramError
+from telegram.ext import MessageHandler, CommandHandler, Filters, CallbackQueryHandler, CallbackContext, \
+    ConversationHandler, TypeHandler, ChatJoinRequestHandler, ChatMemberHandler
 from telegram.utils.helpers import mention_html
 
-from apis.tgram.utils import restricted, reply_func, admin_reply, set_bot
+from apis.tgram.broadcast import SEND_WORKERS, track_managed_chat
+from apis.tgram.challenges import ChallengeBank, ChallengeSet
+from apis.tgram.captcha import PendingCaptcha
+from apis.tgram.cleanup import FLUSH_INTERVAL_SECONDS
+from apis.tgram.errors import FLUSH_INTERVAL_SECONDS as ERROR_FLUSH_INTERVAL_SECONDS
+from apis.tgram.lanes import configure_lanes, in_lane, lanes, lanes_stats, total_lane_threads, \
+    MODERATION, INTERACTIVE, BULK
+from apis.tgram.recorder import UpdateRecorder
+from apis.tgram.routing import UpdateRouter, command, new_chat_members, private_document, update_types
+from apis.tgram import webhook_reply
+from apis.tgram.tenants import TenantHost, TENANT_CONNECTIONS, current_tenant
+from apis.tgram.transport import download_document
+from apis.tgram.utils import restricted, reply_func, admin_reply
+from common.utils import events
 from config.common import deploy_server
-from config.environments import get_bot_token, get_bot_url, get_pinned_message, get_github_token
+from config.environments import get_pinned_message, get_github_token, get_update_log_path, \
+    get_lane_sizes, webhook_reply_enabled, get_announcement_schedule, get_chat_challenge_sets, \
+    get_challenge_sets, get_captcha_timeout, get_tenants, on_config_change, on_config_check, reload_config, \
+    tenant_settings, CONFIG_POLL_SECONDS
 from config.log_config import log_level, getLogger
 from config.version import version
 import datetime as dt
 import dateutil.relativedelta as dtutil
 
 ENTER_PRESENTATION_FILE = 0
+END_UPLOAD = 'END_UPLOAD'
+CAPTCHA_DATA_PATTERN = r'^[^,]+,-?\d+,'
 
 # Enable logging
-CAPTCHA_TIMEOUT_SECONDS = 60
+REPUTATION_SNAPSHOT_SECONDS = 300
+EVENTS_SNAPSHOT_SECONDS = 300
+DEFAULT_STATS_HOURS = 24
+
+DECOYS = {
+    "bistec": "🥩",
+    "kiwi": "🥝",
+    "bacon": "🥓",
+    "coco": "🥥",
+    "donut": "🍩",
+    "taco": "🌮",
+    "pizza": "🍕",
+    "ensalada": "🥗",
+    "plátano": "🍌",
+    "castaña": "🌰",
+    "chupachups": "🍭",
+    "aguacate": "🥑",
+    "pollo": "🍗",
+    "sandwich": "🥪",
+    "pepino": "🥒",
+}
 
 CORRECT_ANSWERS = {
     "leche": "🥛",
@@ -44,44 +84,139 @@ CORRECT_ANSWERS = {
 }
 
 logger = getLogger(__name__)
-updater = Updater(get_bot_token())
+configure_lanes(get_lane_sizes())
+# The updates wanted by the handlers in register_handlers, the rest are dropped before decoding them.
+# Every update is decoded while recording, so the log has all of them
+update_router = UpdateRouter((command, new_chat_members, private_document,
+                              update_types('callback_query', 'chat_join_request', 'my_chat_member')))
+# Every hosted bot shares the connection pool and the lanes, each keeps its own reputation and moderation events
+host = TenantHost(len(get_tenants()) * TENANT_CONNECTIONS + total_lane_threads() + SEND_WORKERS, admin_reply,
+                  router=None if get_update_log_path() else update_router)
 
 TEST_MESSAGE = 'Hola {}, necesitamos comprobar que no eres un bot, tienes 15s para elegir la bebida que hay en el menú.'
-PINNED_MESSAGE = get_pinned_message()
-WELCOME_MESSAGE = 'Has superado la prueba. Te damos la bienvenida, {}!!! \n' + PINNED_MESSAGE
+WELCOME_MESSAGE = 'Has superado la prueba. Te damos la bienvenida, {}!!! \n'
 BAN_MESSAGE = 'El usuario {} ha sido exiliado por no resolver el captcha a tiempo. Me he ganado un +1'
+JOIN_REQUEST_DECLINED_MESSAGE = 'Respuesta incorrecta. Tu solicitud para unirte al grupo ha sido rechazada.'
+JOIN_REQUEST_TIMEOUT_MESSAGE = 'No has respondido a tiempo. Tu solicitud para unirte al grupo ha sido rechazada.'
+JOIN_REQUEST_EXPIRED_MESSAGE = 'Esta solicitud ya no está pendiente.'
+
+
+
+def build_challenge_bank():
+    """
+    Builds the challenge bank from the built-in set and the ones in the config
+    of every tenant, assigned to chats with CHAT_CHALLENGE_SETS
+    :return: the ChallengeBank
+    """
+    specs = {}
+    chat_sets = {}
+    for name in get_tenants():
+        with tenant_settings(name):
+            specs.update(get_challenge_sets())
+            chat_sets.update(get_chat_challenge_sets())
+    sets = [ChallengeSet('bebidas', TEST_MESSAGE, DECOYS, CORRECT_ANSWERS)]
+    sets += [ChallengeSet(name, spec['prompt'], spec['decoys'], spec['answers']) for name, spec in specs.items()]
+    return ChallengeBank(sets, chat_sets)
+
+
+challenge_bank = build_challenge_bank()
 
 
 def main():
-    """Start the bot."""
-    # Create the EventHandler and pass it your bot's token.
-    global updater
+    """Start the bots."""
+    update_log_path = get_update_log_path()
+    recorder = UpdateRecorder(update_log_path) if update_log_path else None
+
+    for name, token in get_tenants().items():
+        tenant = host.add(name, token)
+        # Get the dispatcher to register handlers
+        register_handlers(tenant.dispatcher)
+        if recorder:
+            tenant.dispatcher.add_handler(TypeHandler(Update, recorder.record), group=-1)
+        schedule_tenant_jobs(tenant)
+
+    # A config whose challenge sets can't be built is rejected, as the next start would fail
+    on_config_check(build_challenge_bank)
+    on_config_change(apply_config)
+    host.run_repeating(reload_config, CONFIG_POLL_SECONDS)
+    host.run_repeating(snapshot_reputation, REPUTATION_SNAPSHOT_SECONDS)
+    host.run_repeating(snapshot_moderation_events, EVENTS_SNAPSHOT_SECONDS)
 
+    if deploy_server():
+        PORT = int(os.environ.get('PORT', '8443'))  # Telegram supported without reverse proxy: 443, 80, 88 and 8443
+
+        # One server for every bot, each webhook on the path of its token
+        host.start_webhooks("0.0.0.0", PORT, inline_reply=webhook_reply_enabled())
+    else:
+        # Start the Bots
+        host.start_polling()  # XXX These are supposed to improve UX: poll_interval = 1.0,timeout=20
+
+    for tenant in host.tenants.values():
+        with tenant.activate():
+            tenant.broadcasts.resume(tenant.bot)
+            try:
+                admin_reply('Bot iniciado')
+            except Exception as e:
+                logger.exception('Error when trying to notify the init completion')
+
+
+    # Run the bots until you press Ctrl-C or the process receives SIGINT,
+    # SIGTERM or SIGABRT. This should be used most of the time, since
+    # start_polling() is non-blocking and will stop the bots gracefully.
+    host.idle()
 
-    # schedule_jobs(updater.job_queue)
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+    snapshot_reputation()
+    snapshot_moderation_events()
+    if recorder:
+        recorder.close()
 
+
+def register_handlers(dp):
+    """
+    Registers every handler of this bot in a dispatcher
+    :param dp: the dispatcher
+    """
     # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler('help', show_help))
-    dp.add_handler(CommandHandler('log', log, pass_args=True))
+    # Each handler runs in its lane: moderation, interactive or bulk (slow I/O)
+    dp.add_handler(CommandHandler('help', in_lane(INTERACTIVE, show_help)))
+    dp.add_handler(CommandHandler('log', in_lane(INTERACTIVE, log), pass_args=True))
+    # Out of the lanes, so it still answers when they are all saturated
+    dp.add_handler(CommandHandler('lanes', show_lanes))
+    dp.add_handler(CommandHandler('stats', in_lane(INTERACTIVE, show_stats)))
+    dp.add_handler(CommandHandler('broadcast', in_lane(INTERACTIVE, broadcast)))
     dp.add_handler(CommandHandler('quit', quit_bot))
     dp.add_handler(CommandHandler('restart', restart))
 
     dp.add_handler(MessageHandler(Filters.status_update.new_chat_members,
-                                  manage_new_member))
-
-    dp.add_handler(CallbackQueryHandler(captcha_button_pressed))
-
-    conv_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler('addpresentations', ask_for_presentations),
-        ],
-        states={
-            ENTER_PRESENTATION_FILE: [MessageHandler(Filters.chat_type.private & Filters.document, upload_document)],
-        },
-        fallbacks=[],
-    )
+                                  in_lane(MODERATION, manage_new_member)))
+
+    dp.add_handler(ChatMemberHandler(in_lane(MODERATION, manage_my_chat_member), ChatMemberHandler.MY_CHAT_MEMBER))
+    dp.add_handler(ChatJoinRequestHandler(in_lane(MODERATION, manage_join_request)))
+
+    # Captcha buttons carry '<answer>,<user id or chat asked to join>,<first name>'
+    dp.add_handler(CallbackQueryHandler(in_lane(MODERATION, captcha_button_pressed), pattern=CAPTCHA_DATA_PATTERN))
+
+    # The conversation callbacks run on the dispatcher thread: from a lane they would return
+    # a Promise, and the persisted state would only be resolved on the next update of the chat.
+    # The slow part of upload_document goes to the bulk lane on its own
+    # FINALIZAR ends the conversation of the chat whichever message it is pressed on,
+    # which is what per_message=False does, so PTB's warning about it is silenced
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message="If 'per_message=False'", category=UserWarning)
+        conv_handler = ConversationHandler(
+            entry_points=[
+                CommandHandler('addpresentations', ask_for_presentations),
+            ],
+            states={
+                ENTER_PRESENTATION_FILE: [MessageHandler(Filters.chat_type.private & Filters.document,
+                                                         upload_document),
+                                          CallbackQueryHandler(end_upload, pattern=f'^{END_UPLOAD}$')],
+            },
+            fallbacks=[],
+            name='addpresentations',
+            persistent=True,
+            per_message=False,
+        )
     dp.add_handler(conv_handler)
 
     # dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.document, upload_document))
@@ -89,63 +224,47 @@ def main():
     # log all errors
     dp.add_error_handler(error_handler)
 
-    if deploy_server():
-        PORT = int(os.environ.get('PORT', '8443'))  # Telegram supported without reverse proxy: 443, 80, 88 and 8443
-
-
-        webhook_url = "https://{}.herokuapp.com/{}".format(get_bot_url(), get_bot_token())
-        updater.start_webhook(listen="0.0.0.0",
-                              port=PORT,
-                              url_path=get_bot_token(),
-                              webhook_url=webhook_url)
-    else:
-        # Start the Bot
-        updater.start_polling()  # XXX These are supposed to improve UX: poll_interval = 1.0,timeout=20
-
-    set_bot(updater.bot)
-
-    try:
-        admin_reply('Bot iniciado')
-    except Exception as e:
-        logger.exception('Error when trying to notify the init completion')
-
-
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
-
 
 def ask_for_presentations(update: Update, context: CallbackContext):
     context.bot.send_message(update.effective_chat.id, 'Envíe ahora al bot su fichero o sus ficheros de la presentación/charla')
     reply_keyboard = [
-        [InlineKeyboardButton('FINALIZAR', callback_data='END_UPLOAD'),]
+        [InlineKeyboardButton('FINALIZAR', callback_data=END_UPLOAD),]
     ]
     reply_markup = InlineKeyboardMarkup(reply_keyboard)
     context.bot.send_message(update.effective_chat.id, 'O presione el botón para dar por finalizada la subida', reply_markup=reply_markup)
     return ENTER_PRESENTATION_FILE
 
 
+def end_upload(update: Update, context: CallbackContext):
+    update.callback_query.answer('Subida de documentos finalizada')
+    return ConversationHandler.END
+
+
 def upload_document(update: Update, context: CallbackContext):
-    if update.callback_query:
-        if update.callback_query.data == 'END_UPLOAD':
-            update.callback_query.answer('Subida de documentos finalizada')
-            return ConversationHandler.END
+    lanes[BULK].submit(context.dispatcher, store_presentation, update, context)
+    return ENTER_PRESENTATION_FILE
 
-    import io
+
+def store_presentation(update: Update, context: CallbackContext):
+    """
+    Downloads a presentation sent to the bot and commits it to the community repository
+    :param update: the update info from Telegram with the document
+    :param context: the context
+    """
+    import tempfile
     from github import Github
 
     g = Github(get_github_token())
 
     repo = g.get_repo('pythoncoruna/main')
 
-    received_file: telegram.File = context.bot.get_file(update.message.document.file_id)
-    content_stream = io.BytesIO()
-    received_file.download(out=content_stream)
-    try:
-        content = content_stream.getvalue().decode('utf-8')
-    except UnicodeDecodeError:
-        content = content_stream.getvalue()
+    with tempfile.TemporaryDirectory() as download_dir:
+        local_path = download_document(context.bot, update.message.document.file_id,
+                                       os.path.join(download_dir, 'document'))
+        # The contents API takes the whole file base64 encoded in a JSON body, so it can't be
+        # streamed. The bytes go as they are, create_file would encode a decoded text again
+        with open(local_path, 'rb') as document:
+            content = document.read()
     path = f'resources/presentations/{update.message.document.file_name}'
     repo.create_file(path, f'Subida de {update.message.document.file_name}', content)
 
@@ -154,8 +273,6 @@ def upload_document(update: Update, context: CallbackContext):
     except:
         pass
 
-    return ENTER_PRESENTATION_FILE
-
 
 def shutdown(update, context):
     """
@@ -165,8 +282,8 @@ def shutdown(update, context):
     """
     reply = reply_func(update)
     reply('Finalizando bot...')
-    updater.stop()
-    updater.is_idle = False
+    host.stop()
+    host.is_idle = False
     reply('Bot apagado.')
 
 
@@ -186,9 +303,9 @@ def quit_bot(update, context):
 
 def stop_and_restart():
     """
-    Gracefully stops the Updater and replaces the current process with a new one
+    Gracefully stops every bot and replaces the current process with a new one
     """
-    updater.stop()
+    host.stop()
     os.execl(sys.executable, sys.executable, *sys.argv)
 
 
@@ -225,6 +342,140 @@ def log(update, context):
         reply('Valor no válido')
 
 
+@restricted(logger)
+def show_lanes(update, context):
+    """
+    Shows the queue depth and wait times of every execution lane
+    :param update: the update info from Telegram for this command
+    :param context: the context
+    """
+    lines = [f"{stats['name']} ({stats['size']}): {stats['queued']} en cola, {stats['running']} en curso, "
+             f"{stats['completed']} completadas, espera p50 {stats['wait_p50_ms']:.0f} ms, "
+             f"p95 {stats['wait_p95_ms']:.0f} ms, máx {stats['wait_max_ms']:.0f} ms"
+             for stats in lanes_stats()]
+    lines.append(f'Updates: {update_router.kept} procesados, {update_router.dropped} descartados sin decodificar')
+    reply = reply_func(update)
+    reply('\n'.join(lines))
+
+
+@restricted(logger)
+def show_stats(update, context):
+    """
+    Shows the moderation activity of every chat in the last hours, 24 by default
+    :param update: the update info from Telegram for this command
+    :param context: the context
+    """
+    reply = reply_func(update)
+    try:
+        hours = float(context.args[0]) if context.args else DEFAULT_STATS_HOURS
+    except ValueError:
+        reply('Valor no válido')
+        return
+
+    tenant = current_tenant()
+    chats = tenant.moderation_events.stats(since=time.time() - hours * 3600, chat_ids=tenant.broadcasts.store.chats())
+    if not chats:
+        reply(f'Sin actividad en las últimas {hours:g} horas')
+        return
+
+    lines = [f'Actividad en las últimas {hours:g} horas:']
+    for stats in chats:
+        shown = stats['captcha']
+        pass_rate = f"{stats['passed'] / shown:.0%}" if shown else '-'
+        answer = f"respuesta p50 {stats['answer_p50_ms'] / 1000:.1f} s, p95 {stats['answer_p95_ms'] / 1000:.1f} s" \
+            if stats['answer_p50_ms'] is not None else 'sin respuestas'
+        lines.append(f"{stats['chat_id']}: {stats['join']} entradas, {shown} captchas, {stats['passed']} superados "
+                     f"({pass_rate}), {stats['failed']} fallados, {stats['timeout_ban']} expulsados por tiempo, "
+                     f"{stats['bot_ban'] + stats['known_ban']} bots o conocidos, {answer}")
+    reply('\n'.join(lines))
+
+
+@restricted(logger)
+def broadcast(update, context):
+    """
+    Sends the text after the command to every chat the bot moderates
+    :param update: the update info from Telegram for this command
+    :param context: the context
+    """
+    reply = reply_func(update)
+    parts = update.effective_message.text.split(None, 1)
+    if len(parts) < 2:
+        reply('Uso: /broadcast <texto>')
+        return
+
+    broadcast_id, total = current_tenant().broadcasts.start(context.bot, parts[1])
+    reply(f'Difusión {broadcast_id} iniciada a {total} grupos')
+
+
+def schedule_tenant_jobs(tenant):
+    """
+    Schedules the periodic jobs of a hosted bot
+    :param tenant: the Tenant
+    """
+    tenant.job_queue.run_repeating(tenant.cleaner.flush_job, FLUSH_INTERVAL_SECONDS)
+    tenant.job_queue.run_repeating(tenant.errors.flush_job, ERROR_FLUSH_INTERVAL_SECONDS)
+    with tenant.activate():
+        schedule_jobs(tenant.job_queue)
+
+
+def schedule_jobs(job_queue):
+    """
+    Schedules the periodic announcements of the active tenant
+    :param job_queue: the job queue
+    """
+    for job in job_queue.get_jobs_by_name('pinned_announcement'):
+        job.schedule_removal()
+    schedule = get_announcement_schedule()
+    if schedule:
+        announcement_time, days = schedule
+        job_queue.run_daily(announce_pinned_message, announcement_time, days=days, name='pinned_announcement')
+
+
+def announce_pinned_message(context: telegram.ext.callbackcontext.CallbackContext):
+    pinned_message = get_pinned_message()
+    if pinned_message:
+        current_tenant().broadcasts.start(context.bot, pinned_message)
+
+
+def snapshot_reputation():
+    """
+    Writes the reputation of every hosted bot to its file
+    """
+    for tenant in host.tenants.values():
+        tenant.reputation.snapshot()
+
+
+def snapshot_moderation_events():
+    """
+    Writes the moderation events of every hosted bot to their file
+    """
+    for tenant in host.tenants.values():
+        tenant.moderation_events.snapshot()
+
+
+def apply_config(values):
+    """
+    Applies a reloaded config to what is built from it at startup.
+    Everything else reads the config on every use
+    :param values: the new settings
+    """
+    global challenge_bank
+    challenge_bank = build_challenge_bank()
+    for tenant in host.tenants.values():
+        with tenant.activate():
+            schedule_jobs(tenant.job_queue)
+
+
+def manage_my_chat_member(update: telegram.Update, context: telegram.ext.callbackcontext.CallbackContext):
+    """
+    Keeps track of the chats the bot is added to or removed from
+
+    :param context: the context
+    :param update: the update info from Telegram for this command
+    """
+    track_managed_chat(current_tenant().broadcasts.store, update.my_chat_member)
+
+
 def show_help(update, context):
     """
     Send a message when the command /help is issued.
@@ -235,6 +486,9 @@ def show_help(update, context):
                 'Este bot creará un borrador de forma automática en blogger al introducir una URL seguida del título deseado\n' \
                 '  /help - Muestra la ayuda\n' \
                 '  /addpresentation - Sube documento relativo a unha charla/presentación\n' \
+                '  /lanes - Muestra el estado de las colas de ejecución\n' \
+                '  /stats [horas] - Muestra la actividad de moderación por grupo\n' \
+                '  /broadcast <texto> - Envía un mensaje a todos los grupos moderados\n' \
                 '  /quit - Detiene completamente el bot\n' \
                 '  /restart - Reinicia el bot\n'
 
@@ -245,12 +499,16 @@ def show_help(update, context):
 
 def error_handler(update, context):
     """
-    Logs errors caused by updates.
+    Logs errors caused by updates, aggregated by fingerprint.
     Does not use @run_async for complicated reasons (ptb developer said)
     :param context: the context
     :param update: the update info from Telegram for this command
     """
-    logger.warning('La actualización "%s" causó el error "%s"', update, context.error)
+    tenant = current_tenant()
+    if tenant is None:
+        logger.error('Error fuera de cualquier bot alojado', exc_info=context.error)
+        return
+    tenant.errors.report(context.error, update)
 
 
 def manage_new_member(update: telegram.Update, context: telegram.ext.callbackcontext.CallbackContext):
@@ -262,30 +520,56 @@ def manage_new_member(update: telegram.Update, context: telegram.ext.callbackcon
     """
     member: telegram.User
     logger.info('New member detected')
+    tenant = current_tenant()
+    tenant.cleaner.schedule(context.bot, update.effective_chat.id, update.effective_message.message_id)
+    tenant.broadcasts.store.add_chat(update.effective_chat.id, update.effective_chat.title)
     for member in update.effective_message.new_chat_members:
+        tenant.moderation_events.record(events.JOIN, update.effective_chat.id, member.id)
         if member.is_bot:
             context.bot.ban_chat_member(update.effective_chat.id, member.id, until_date=forever_dt())
+            tenant.moderation_events.record(events.BOT_BAN, update.effective_chat.id, member.id)
+
+        if tenant.approved_joins.pop(update.effective_chat.id, member.id):
+            continue
 
         if context.bot.id != member.id:
+            # Users already known from another chat skip the captcha
+            if tenant.reputation.is_verified(member.id):
+                continue
+            if tenant.reputation.is_banned(member.id):
+                context.bot.ban_chat_member(update.effective_chat.id, member.id, until_date=forever_dt())
+                tenant.moderation_events.record(events.KNOWN_BAN, update.effective_chat.id, member.id)
+                continue
+
+            start = time.perf_counter()
             revoke_member_permissions(context, update, member)
-            message = reply_captcha_to_user(update, member)
+
+            # Registered before sending the captcha, as the answer may arrive in another lane thread
+            timeout = get_captcha_timeout()
+            pending = PendingCaptcha(update.effective_chat.id, member.id, None, member.first_name, timeout)
+            tenant.pending_captchas.add(pending)
+            message = reply_captcha_to_user(update, member, pending)
+            pending.message_id = message.message_id if message else None
+            tenant.moderation_events.record(events.CAPTCHA_SHOWN, pending.chat_id, pending.user_id,
+                                            (time.perf_counter() - start) * 1000)
 
             captcha_args = {
                 'kwargs': {
-                    'member': member,
-                    'chat_id': update.effective_chat.id,
-                    'message': message
+                    'chat_id': pending.chat_id,
+                    'user_id': pending.user_id,
                 }
             }
-            context.job_queue.run_once(captcha_ban_if_timeout, CAPTCHA_TIMEOUT_SECONDS,
-                                       name=str(member.id),
-                                       job_kwargs=captcha_args)
+            pending.job = context.job_queue.run_once(captcha_ban_if_timeout, timeout,
+                                                     name=f'{pending.chat_id}:{pending.user_id}',
+                                                     job_kwargs=captcha_args)
 
 
-def reply_captcha_to_user(update, member):
+def reply_captcha_to_user(update, member, pending):
     reply = reply_func(update)
-    markup = get_keyboard_markup(member)
-    message = reply(TEST_MESSAGE.format(mention_html(member.id, member.first_name)), reply_markup=markup, parse_mode='HTML')
+    challenge = challenge_bank.draw(update.effective_chat.id)
+    pending.answer = challenge.answer
+    message = reply(challenge.prompt.format(mention_html(member.id, member.first_name)),
+                    reply_markup=challenge.markup(member.id, member.first_name), parse_mode='HTML')
     return message
 
 
@@ -306,6 +590,10 @@ def revoke_member_permissions(context, update, member):
 
 def captcha_button_pressed(update: telegram.Update, context: telegram.ext.callbackcontext.CallbackContext):
     query = update.callback_query
+    webhook_reply.call(context.bot, update, 'answerCallbackQuery', callback_query_id=query.id)
+    if query.message.chat.type == Chat.PRIVATE:
+        return join_request_button_pressed(update, context)
+
     query_data = query.data.split(",", 2)
     drink_selected = query_data[0]
     str_id_who_entered_the_chat = query_data[1]
@@ -315,25 +603,121 @@ def captcha_button_pressed(update: telegram.Update, context: telegram.ext.callba
     id_who_pressed_button = query.from_user.id
 
     if id_who_pressed_button == id_who_entered_the_chat:
-        job_to_be_cancelled = None
-        jobs_tuple = context.job_queue.get_jobs_by_name(str_id_who_entered_the_chat)
-        try:
-            job_to_be_cancelled = jobs_tuple[0]
-        except IndexError:
-            pass
-        if drink_selected in CORRECT_ANSWERS.keys():
-            if job_to_be_cancelled:
-                job_to_be_cancelled.job.remove()
+        tenant = current_tenant()
+        pending = tenant.pending_captchas.pop(update.effective_chat.id, id_who_entered_the_chat)
+        if pending and pending.job:
+            pending.job.schedule_removal()
+        if pending:
+            passed = drink_selected == pending.answer
+        else:
+            passed = challenge_bank.is_answer(update.effective_chat.id, drink_selected)
+        # Without the pending captcha the answer was already counted, or came after the timeout
+        if pending:
+            tenant.moderation_events.record(events.PASSED if passed else events.FAILED, update.effective_chat.id,
+                                            id_who_entered_the_chat, answer_latency(pending))
+        if passed:
+            tenant.reputation.mark_verified(id_who_entered_the_chat)
             grant_permissions_to_user(context, update, id_who_entered_the_chat)
-            update.effective_chat.send_message(WELCOME_MESSAGE.format(person_name))
-            context.bot.delete_message(
-                chat_id=update.callback_query.message.chat_id,
-                message_id=update.callback_query.message.message_id
-            )
+            update.effective_chat.send_message(WELCOME_MESSAGE.format(person_name) + get_pinned_message())
+            tenant.cleaner.schedule(context.bot, query.message.chat_id, query.message.message_id)
         else:
             query.edit_message_text(text=f"🚨 El usuario {person_name} es sospechoso y fue puesto en cuarentena! 🚨")
-            if job_to_be_cancelled:
-                job_to_be_cancelled.job.remove()
+
+
+def manage_join_request(update: telegram.Update, context: telegram.ext.callbackcontext.CallbackContext):
+    """
+    Sends the captcha privately to a user asking to join a chat with join requests enabled.
+    The request is approved or declined from the answer, so the user is never
+    restricted and nothing is posted in the group.
+
+    :param context: the context
+    :param update: the update info from Telegram for this command
+    """
+    join_request = update.chat_join_request
+    member = join_request.from_user
+    tenant = current_tenant()
+    logger.info('New join request detected')
+    tenant.moderation_events.record(events.JOIN, join_request.chat.id, member.id)
+
+    if tenant.reputation.is_verified(member.id):
+        tenant.approved_joins.add(join_request.chat.id, member.id)
+        context.bot.approve_chat_join_request(join_request.chat.id, member.id)
+        return
+    if tenant.reputation.is_banned(member.id):
+        context.bot.decline_chat_join_request(join_request.chat.id, member.id)
+        return
+
+    # A newer request from the same user to the same chat replaces the one still pending
+    previous = tenant.pending_join_requests.pop(join_request.chat.id, member.id)
+    if previous and previous.job:
+        previous.job.schedule_removal()
+
+    timeout = get_captcha_timeout()
+    pending = PendingCaptcha(member.id, member.id, None, member.first_name,
+                             timeout, join_chat_id=join_request.chat.id)
+    tenant.pending_join_requests.add(pending)
+    challenge = challenge_bank.draw(join_request.chat.id)
+    pending.answer = challenge.answer
+    try:
+        message = context.bot.send_message(member.id,
+                                           challenge.prompt.format(mention_html(member.id, member.first_name)),
+                                           reply_markup=challenge.markup(join_request.chat.id, member.first_name),
+                                           parse_mode='HTML')
+    except TelegramError as e:
+        # Eg. the user blocked the bot: without a captcha nor its timeout, the request is declined now
+        logger.warning('No se pudo enviar el captcha de la solicitud de %s: %s', member.id, e)
+        if tenant.pending_join_requests.pop(join_request.chat.id, member.id):
+            context.bot.decline_chat_join_request(join_request.chat.id, member.id)
+        return
+    pending.message_id = message.message_id
+    tenant.moderation_events.record(events.CAPTCHA_SHOWN, pending.join_chat_id, pending.user_id)
+
+    captcha_args = {
+        'kwargs': {
+            'chat_id': pending.join_chat_id,
+            'user_id': pending.user_id,
+        }
+    }
+    pending.job = context.job_queue.run_once(join_request_decline_if_timeout, timeout,
+                                             name=f'{pending.join_chat_id}:{pending.user_id}',
+                                             job_kwargs=captcha_args)
+
+
+def join_request_button_pressed(update: telegram.Update, context: telegram.ext.callbackcontext.CallbackContext):
+    query = update.callback_query
+    drink_selected, join_chat_id, person_name = query.data.split(",", 2)
+    tenant = current_tenant()
+
+    pending = tenant.pending_join_requests.pop(int(join_chat_id), query.from_user.id)
+    if not pending:
+        query.edit_message_text(text=JOIN_REQUEST_EXPIRED_MESSAGE)
+        return
+    if pending.job:
+        pending.job.schedule_removal()
+
+    passed = drink_selected == pending.answer
+    tenant.moderation_events.record(events.PASSED if passed else events.FAILED, pending.join_chat_id,
+                                    pending.user_id, answer_latency(pending))
+    if passed:
+        tenant.approved_joins.add(pending.join_chat_id, pending.user_id)
+        tenant.reputation.mark_verified(pending.user_id)
+        context.bot.approve_chat_join_request(pending.join_chat_id, pending.user_id)
+        query.edit_message_text(text=WELCOME_MESSAGE.format(person_name) + get_pinned_message())
+    else:
+        context.bot.decline_chat_join_request(pending.join_chat_id, pending.user_id)
+        query.edit_message_text(text=JOIN_REQUEST_DECLINED_MESSAGE)
+
+
+def join_request_decline_if_timeout(context: telegram.ext.callbackcontext.CallbackContext, chat_id, user_id):
+    tenant = current_tenant()
+    pending = tenant.pending_join_requests.pop(chat_id, user_id)
+    if not pending:
+        return
+    context.bot.decline_chat_join_request(chat_id, user_id)
+    tenant.moderation_events.record(events.TIMEOUT_BAN, chat_id, user_id, (time.time() - pending.deadline) * 1000)
+    if pending.message_id:
+        context.bot.edit_message_text(JOIN_REQUEST_TIMEOUT_MESSAGE, chat_id=pending.chat_id,
+                                      message_id=pending.message_id)
 
 
 def grant_permissions_to_user(context, update, id_who_entered_the_chat):
@@ -350,9 +734,28 @@ def grant_permissions_to_user(context, update, id_who_entered_the_chat):
     )
 
 
-def captcha_ban_if_timeout(context: telegram.ext.callbackcontext.CallbackContext, member: telegram.User, chat_id, message: telegram.Message):
-    context.bot.ban_chat_member(chat_id, member.id, until_date=forever_dt())
-    message.edit_text(BAN_MESSAGE.format(member.first_name), reply_markup=None)
+def captcha_ban_if_timeout(context: telegram.ext.callbackcontext.CallbackContext, chat_id, user_id):
+    tenant = current_tenant()
+    pending = tenant.pending_captchas.pop(chat_id, user_id)
+    if not pending:
+        return
+    context.bot.ban_chat_member(chat_id, user_id, until_date=forever_dt())
+    tenant.reputation.mark_banned(user_id)
+    tenant.moderation_events.record(events.TIMEOUT_BAN, chat_id, user_id, (time.time() - pending.deadline) * 1000)
+    logger.info(BAN_MESSAGE.format(pending.name))
+    if pending.message_id:
+        tenant.cleaner.schedule(context.bot, chat_id, pending.message_id)
+
+
+def answer_latency(pending):
+    """
+    Returns how long the user took to answer a captcha
+    :param pending: the PendingCaptcha, None if it was already resolved
+    :return: the milliseconds since the captcha was registered, NaN if unknown
+    """
+    if not pending:
+        return float('nan')
+    return (time.time() - pending.created) * 1000
 
 
 def forever_dt():
@@ -363,45 +766,5 @@ def kick_dt():
     return dt.datetime.now() + dt.timedelta(seconds=32)
 
 
-def get_keyboard_markup(member):
-    keyboard_items = [
-        InlineKeyboardButton("🥩", callback_data=f'bistec,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥝", callback_data=f'kiwi,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥓", callback_data=f'bacon,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥥", callback_data=f'coco,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🍩", callback_data=f'donut,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🌮", callback_data=f'taco,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🍕", callback_data=f'pizza,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥗", callback_data=f'ensalada,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🍌", callback_data=f'plátano,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🌰", callback_data=f'castaña,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🍭", callback_data=f'chupachups,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥑", callback_data=f'aguacate,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🍗", callback_data=f'pollo,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥪", callback_data=f'sandwich,{member.id},{member.first_name}'),
-        InlineKeyboardButton("🥒", callback_data=f'pepino,{member.id},{member.first_name}'),
-    ]
-
-    solution_key, solution_emoji = rnd.choice(list(CORRECT_ANSWERS.items()))
-    keyboard_items.append(InlineKeyboardButton(f"{solution_emoji}", callback_data=f'{solution_key},{member.id},{member.first_name}'))
-
-    rnd.shuffle(keyboard_items)
-
-    keyboard = []
-    counter = 0
-    NUM_FILAS = 4
-    NUM_BOTONES = 4
-    for i in range(NUM_FILAS):  # create a list of the rows contained in the keyboard
-        row = []
-        for n in range(NUM_BOTONES):
-            keyboard_item = keyboard_items[counter]
-            row.append(keyboard_item)  # fills nested lists with data
-            counter += 1
-        keyboard.append(row)
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return reply_markup
-
-
 if __name__ == '__main__':
     main()